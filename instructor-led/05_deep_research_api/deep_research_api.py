@@ -1,25 +1,36 @@
 from __future__ import annotations
 import asyncio
+import hashlib
 import os
-from dataclasses import dataclass, field
+import time
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
 from datetime import datetime, timezone
-from typing import List, Sequence
+from typing import TYPE_CHECKING, List, Literal, NamedTuple, Sequence
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
-import openai
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from openai import AzureOpenAI
+from pydantic import BaseModel, Field, field_validator
 import json
 from dotenv import load_dotenv
-import wikipediaapi
-import requests
+import multiprocessing
+import queue
+import re
+import tempfile
+import threading
+import uuid
 
-import os
-from azure.ai.projects import AIProjectClient
-from azure.identity import DefaultAzureCredential
-from azure.ai.agents.models import CodeInterpreterTool, MessageRole, FilePurpose, MessageAttachment, CodeInterpreterToolDefinition
+# The Azure and OpenAI SDKs and NumPy are imported on first use, not at module
+# load, so the API process (and every autoscaled replica) starts quickly.
+# Run `python startup_benchmark.py` after touching the imports above.
+if TYPE_CHECKING:
+    import numpy as np
+    from openai import AzureOpenAI
+    from azure.ai.projects import AIProjectClient
 
 # --------------------------------------------------------------------- #
 # 0️⃣  Configuration
@@ -27,81 +38,791 @@ from azure.ai.agents.models import CodeInterpreterTool, MessageRole, FilePurpose
 load_dotenv(override=True)  # Load environment variables from a .env file
 GPT_MODEL = os.getenv("AOAI_GPT_MODEL", "gpt-4.1")
 REASONING_MODEL = os.getenv("AOAI_REASONING_MODEL", "o4-mini")
+EMBEDDING_MODEL = os.getenv("AOAI_EMBEDDING_MODEL", "")  # e.g. text-embedding-3-small; empty = exact-match dedup, no ranking
+
+FAST_MODEL = os.getenv("AOAI_FAST_MODEL", "gpt-4.1-mini")  # optional cheaper deployment for follow-up generation
+
+@dataclass(frozen=True)
+class Route:
+    """Deployments serving one pipeline stage: primary first, throttling fallbacks after."""
+    deployments: tuple[str, ...]
+    reasoning: bool = False        # o-series: max_completion_tokens + reasoning_effort, no temperature
+    effort: str | None = None
+
+def _route(stage: str, default: Sequence[str], reasoning: bool = False, effort: str | None = None) -> Route:
+    """Build a route, overridable with AOAI_ROUTE_<STAGE>=dep1,dep2 and AOAI_EFFORT_<STAGE>=low|medium|high."""
+    raw = os.getenv(f"AOAI_ROUTE_{stage.upper()}") or ",".join(default)
+    deployments = tuple(d.strip() for d in raw.split(",") if d.strip())
+    return Route(deployments, reasoning, os.getenv(f"AOAI_EFFORT_{stage.upper()}", effort) if reasoning else None)
+
+ROUTES = {
+    "chat":        _route("chat", [GPT_MODEL]),
+    "reason":      _route("reason", [REASONING_MODEL], reasoning=True, effort="medium"),
+    "queries":     _route("queries", [GPT_MODEL]),
+    "distil":      _route("distil", [GPT_MODEL]),
+    "distil_fast": _route("distil_fast", [FAST_MODEL, GPT_MODEL]),
+    "summarize":   _route("summarize", [GPT_MODEL]),
+    "outline":     _route("outline", [GPT_MODEL]),
+    "report":      _route("report", [REASONING_MODEL], reasoning=True, effort="medium"),
+    "section":     _route("section", [REASONING_MODEL], reasoning=True, effort="medium"),
+    "summary":     _route("summary", [REASONING_MODEL], reasoning=True, effort="low"),
+}
+
+EMBED_BATCH_SIZE = 64        # inputs per embeddings request
+DEDUP_THRESHOLD = 0.92       # cosine similarity above which two learnings count as duplicates
+REPORT_TOP_K = 40            # learnings handed to the report writer
+REPORT_SECTIONS = 5          # max sections in a sectioned report outline
+SECTION_TOP_K = 15           # learnings handed to each section writer
+REPORT_CONCURRENCY = 6       # sections written in parallel
+
+# Distributed mode: leave RESEARCH_BROKER_URL empty to research in the API
+# process's threads, "local" for a pool of worker processes on this machine,
+# or redis://host:6379/0 to share tasks with `python deep_research_api.py worker`.
+BROKER_URL = os.getenv("RESEARCH_BROKER_URL", "")
+LOCAL_WORKERS = int(os.getenv("RESEARCH_LOCAL_WORKERS", "4"))             # processes started by the local broker
+WORKER_CONCURRENCY = int(os.getenv("RESEARCH_WORKER_CONCURRENCY", "4"))   # tasks in flight per worker process
+NODE_TIMEOUT = float(os.getenv("RESEARCH_NODE_TIMEOUT", "600"))           # seconds without any result before giving up
+
+MAX_SESSIONS = 100  # finished sessions kept for /sessions/{id}/tree
+
+# Tenants: nodes from every session share up to NODE_THREADS threads, started
+# on demand and handed out by weighted fair queuing across tenants. TENANT_QUOTAS maps a tenant (or "*"
+# for everyone else) to {"weight", "max_nodes", "tokens_per_hour"}; a 0 limit
+# means unlimited, e.g. {"team-a": {"weight": 2, "max_nodes": 8}, "*": {"tokens_per_hour": 2000000}}.
+# Usage is counted per process: with N uvicorn workers or replicas, a tenant
+# can use up to N times its max_nodes and tokens_per_hour.
+TENANT_QUOTAS = json.loads(os.getenv("TENANT_QUOTAS", "{}"))
+NODE_THREADS = int(os.getenv("RESEARCH_NODE_THREADS", "128"))   # enough for ~25 sessions at CONCURRENCY
+TOKEN_WINDOW = 3600.0                                          # seconds covered by tokens_per_hour
+
+# Batch runner (`python deep_research_api.py batch topics.txt --out results.jsonl`)
+BATCH_WORKERS = int(os.getenv("RESEARCH_BATCH_WORKERS", "2"))   # topics researched at the same time
+BATCH_REPORT_PROMPT = "Write a detailed, well-structured research report that answers the research question. Keep the [n] source markers from the learnings next to the statements they support."
+
+# Streaming: each response buffers at most EVENT_BUFFER_BYTES of rendered
+# events. Beyond that, producers block, which holds back follow-up scheduling
+# while a client reads slowly. A client that reads nothing for
+# EVENT_STALL_SECONDS while producers wait is dropped and its session cancelled.
+EVENT_BUFFER_BYTES = int(os.getenv("EVENT_BUFFER_BYTES", str(1 << 20)))
+EVENT_STALL_SECONDS = float(os.getenv("EVENT_STALL_SECONDS", "60"))
+EVENT_SPILL_BYTES = 64 << 10                  # larger chunks wait in a temporary file, not in memory
+LOW_PRIORITY_EVENTS = ("status", "phase", "quota")   # progress: never blocks, a queued one is replaced by the next
+
+# Response cache: chat()/reason() results keyed on a hash of deployments,
+# messages and parameters. The disk tier is shared by processes on one host.
+LLM_CACHE = os.getenv("LLM_CACHE", "1") != "0"                       # "0" turns memoisation off
+LLM_CACHE_MEMORY_MB = float(os.getenv("LLM_CACHE_MEMORY_MB", "64"))   # in-memory LRU size
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "")                        # empty = no disk tier
+LLM_CACHE_DISK_MB = float(os.getenv("LLM_CACHE_DISK_MB", "512"))      # disk tier size before pruning
+
+# Agent pool and hedging: a node is sent to the historically fastest agent in
+# its pool; if no answer arrives by that agent's HEDGE_PERCENTILE latency, a
+# backup run starts on the next agent and the first good answer wins.
+AGENT_POOL = [a.strip() for a in os.getenv("AGENT_POOL", "").split(",") if a.strip()]
+HEDGE_PERCENTILE = 0.9
+HEDGE_MIN_SAMPLES = 5          # latencies needed before the percentile is trusted
+HEDGE_DEFAULT_DELAY = 90.0     # seconds before hedging while an agent has too few samples
+HEDGE_MAX_BACKUPS = 1          # extra runs per node at most
+LATENCY_WINDOW = 200           # recent latencies kept per agent
+
+# Agent threads hold one question each and are deleted in the background once
+# their answer has been read; "keep" leaves them in the project for inspection.
+AGENT_THREAD_CLEANUP = os.getenv("AGENT_THREAD_CLEANUP", "delete")
+CLEANUP_THREADS = 4            # threads deleting finished agent threads
+
+# Warm-up: import the SDKs, open client connections, fetch a token and look
+# up the agents in the background when the API or a worker starts.
+WARM_UP = os.getenv("RESEARCH_WARM_UP", "1") != "0"
+
+# Adaptive mode: each node's novelty (share of its facts and sources that are
+# new to the session, 0–1) decides whether its branch expands, narrows or stops.
+ADAPTIVE_MAX_FOLLOW_UPS = 4   # follow-ups requested per node; an expanding branch keeps all of them
+NOVELTY_EXPAND = 0.6          # at or above: keep every follow-up
+NOVELTY_STOP = 0.25           # below: terminate the branch
+ADAPTIVE_NODES_PER_LEVEL = 2  # default node budget is breadth * depth * this
 
 DEFAULT_TOP_K = 2
 CONCURRENCY = 2
 
+# Static instructions. Azure OpenAI caches identical prompt prefixes, so every
+# call sends these first, unchanged, and appends per-call content (question,
+# learnings, counts) at the end of the user message.
+QUERIES_PROMPT = "You generate research inquiries based on a research topic or question. You should generate unique questions that are relevant to the topic and can be asked of a subject matter expert. Generate no more than the requested number of UNIQUE questions about the research topic or question presented. These questions should be framed as though they were being asked of a subject matter expert in the area. If previous learnings are provided, use them to avoid asking about what is already known."
+DISTIL_PROMPT = "You generate follow up questions for a research topic or question based on learnings from previous research. Generate the requested number of follow-up questions for the question presented. These follow ups should be based on the learnings provided."
+SUMMARIZE_PROMPT = "You review output from a researcher on a given topic and distill succinct learnings. These learnings should be no more than 5 **very detailed** bullet points containing the most relevant information obtained. These bullets should contain sufficient detail and EACH BULLET SHOULD CONTAIN A SOURCE CITATION. **IMPORTANT:** Sources in the research output are cited with numeric markers such as [3]; cite them by copying those markers exactly. Do not write out URLs or invent markers. **DO NOT** include a list of sources separate from the bulleted learnings. Your learnings should be relevant to the question stated before the research output."
+OUTLINE_PROMPT = "You plan the body of a research report. Given a research question and the learnings gathered so far, you propose the thematic sections the report should contain. Sections must not overlap and must be answerable from the learnings. Do not include an executive summary, introduction or sources section. Propose no more than the requested number of sections. For each section give a short title and one sentence describing its focus."
+SECTION_INSTRUCTIONS = "You are writing ONE section of a larger report; other sections are written separately. Write only the section named at the end of this message, starting with its title as a `##` heading. Do not write a report title, executive summary, conclusion or list of sources."
+CITATION_NOTE = "The research learnings cite their sources with numeric markers such as [3]. Cite sources in your writing with the same markers, exactly as they appear, placed inline next to the statement they support; they are converted to clickable links afterwards. Do not write out URLs or invent markers."
+SUMMARY_INSTRUCTIONS = "The body sections of the report are below. Write only the executive summary for this report, starting with the heading `## Executive Summary`. Ground every statement in the sections and keep their citations."
+
 # --------------------------------------------------------------------- #
 # 1️⃣  Small helpers
 # --------------------------------------------------------------------- #
 
-def chat(messages, **kw) -> str:
-    """Return content of first OpenAI completion choice."""
-    client = AzureOpenAI(
-        azure_endpoint = os.environ['AOAI_ENDPOINT'], 
+class Telemetry:
+    """Thread-safe token counters per pipeline stage, including prompt-cache hits."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: dict[str, dict[str, int]] = {}
+
+    def record(self, stage: str, usage) -> None:
+        if usage is None:
+            return
+        prompt, cached, completion = _usage_counts(usage)
+        with self._lock:
+            row = self._row(stage)
+            row["calls"] += 1
+            row["prompt_tokens"] += prompt
+            row["cached_tokens"] += cached
+            row["completion_tokens"] += completion
+            scope = getattr(_usage_scope, "totals", None)
+            if scope is not None:   # updated under the lock: a scope may be shared by several threads
+                scope["prompt_tokens"] += prompt
+                scope["cached_tokens"] += cached
+                scope["completion_tokens"] += completion
+
+    def fallback(self, stage: str) -> None:
+        with self._lock:
+            self._row(stage)["fallbacks"] += 1
+
+    def memo_hit(self, stage: str) -> None:
+        """A completion for ``stage`` was answered from the response cache."""
+        with self._lock:
+            self._row(stage)["memo_hits"] += 1
+
+    def _row(self, stage: str) -> dict[str, int]:
+        return self._stages.setdefault(stage, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "fallbacks": 0, "memo_hits": 0})
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {k: dict(v) for k, v in self._stages.items()}
+        for row in stages.values():
+            row["cache_hit_ratio"] = round(row["cached_tokens"] / row["prompt_tokens"], 3) if row["prompt_tokens"] else 0.0
+        return stages
+
+def _usage_counts(usage) -> tuple[int, int, int]:
+    """(prompt, cached, completion) token counts from an OpenAI usage object."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return usage.prompt_tokens or 0, getattr(details, "cached_tokens", None) or 0, usage.completion_tokens or 0
+
+_usage_scope = threading.local()
+
+@contextmanager
+def track_usage(totals: dict | None = None):
+    """
+    Also add the token usage of completions made on this thread inside the
+    block to the yielded dict. Pass another thread's dict to share its scope.
+    """
+    totals = totals if totals is not None else {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    previous = getattr(_usage_scope, "totals", None)
+    _usage_scope.totals = totals
+    try:
+        yield totals
+    finally:
+        _usage_scope.totals = previous
+
+TELEMETRY = Telemetry()
+
+class ResponseCache:
+    """
+    Completion texts keyed on a canonical hash of deployments, messages and
+    parameters: an in-memory LRU of about ``memory_bytes`` in front of an
+    optional directory of one file per entry, pruned oldest-used first once
+    it grows past ``disk_bytes``.
+    """
+
+    def __init__(self, memory_bytes: int, directory: str = "", disk_bytes: int = 0):
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._bytes = 0
+        self._memory_bytes = memory_bytes
+        self._dir = directory
+        self._disk_bytes = disk_bytes
+        self._disk_used: int | None = None   # measured on the first write
+        self._lock = threading.Lock()
+        self._counts = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+
+    @staticmethod
+    def key(deployments: Sequence[str], messages, params: dict) -> str:
+        payload = json.dumps({"deployments": list(deployments), "messages": messages, "params": params},
+                             sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+                self._counts["hits"] += 1
+                return text
+        text = self._read(key) if self._dir else None
+        with self._lock:
+            self._counts["misses" if text is None else "disk_hits"] += 1
+        if text is not None:
+            self._remember(key, text)
+        return text
+
+    def put(self, key: str, text: str) -> None:
+        self._remember(key, text)
+        if self._dir:
+            self._write(key, text)
+
+    def _remember(self, key: str, text: str) -> None:
+        size = len(key) + len(text)
+        if size > self._memory_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(key) + len(previous)
+            self._entries[key] = text
+            self._bytes += size
+            while self._bytes > self._memory_bytes:
+                old_key, old_text = self._entries.popitem(last=False)
+                self._bytes -= len(old_key) + len(old_text)
+                self._counts["evictions"] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._dir, key[:2], key + ".json")
+
+    def _read(self, key: str) -> str | None:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                text = json.load(f)["text"]
+            os.utime(path)   # recently used: pruned last
+        except (OSError, ValueError, KeyError):
+            return None
+        return text
+
+    def _write(self, key: str, text: str) -> None:
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"text": text}, f, ensure_ascii=False)
+            os.replace(tmp, path)   # atomic, so concurrent readers never see a partial entry
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_used is not None:
+                self._disk_used += size
+            prune = self._disk_used is None or self._disk_used > self._disk_bytes
+        if prune:
+            self._prune()
+
+    def _prune(self) -> None:
+        """Measure the disk tier and delete least recently used entries down to 90% of its budget."""
+        files = []
+        for root, _dirs, names in os.walk(self._dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        used = sum(size for _mtime, size, _path in files)
+        evicted = 0
+        if used > self._disk_bytes:
+            for _mtime, size, path in sorted(files):
+                if used <= self._disk_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                used -= size
+                evicted += 1
+        with self._lock:
+            self._disk_used = used
+            self._counts["disk_evictions"] += evicted
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {**self._counts, "entries": len(self._entries), "memory_bytes": self._bytes,
+                    "disk_bytes": self._disk_used, "directory": self._dir or None}
+
+RESPONSE_CACHE = ResponseCache(int(LLM_CACHE_MEMORY_MB * 2**20), LLM_CACHE_DIR, int(LLM_CACHE_DISK_MB * 2**20)) if LLM_CACHE else None
+
+_cache_scope = threading.local()
+
+@contextmanager
+def cache_bypass(bypass: bool = True):
+    """Skip the response cache for completions made on this thread inside the block."""
+    previous = getattr(_cache_scope, "bypass", False)
+    _cache_scope.bypass = bypass
+    try:
+        yield
+    finally:
+        _cache_scope.bypass = previous
+
+@lru_cache(maxsize=None)
+def _aoai_client() -> AzureOpenAI:
+    """Shared Azure OpenAI client (one connection pool per process)."""
+    from openai import AzureOpenAI
+    return AzureOpenAI(
+        azure_endpoint = os.environ['AOAI_ENDPOINT'],
         #   azure_ad_token_provider=token_provider,
         api_version="2025-04-01-preview", # You must use this version or greater to access reasoning summary
         api_key = os.environ['AOAI_KEY']
         )
-    resp = client.chat.completions.create(model='gpt-4.1', messages=messages, **kw)
-    return resp.choices[0].message.content
 
-def reason(messages, **kw) -> str:
+def _prepare(stage: str, messages, kw: dict) -> tuple[Route, str | None]:
+    """Apply the route defaults of ``stage`` to ``kw``; return the route and the cache key, or None to skip the cache."""
+    use_cache = kw.pop("cache", True) and RESPONSE_CACHE is not None and not getattr(_cache_scope, "bypass", False)
+    kw.pop("validate", None)
+    route = ROUTES[stage]
+    if route.reasoning:
+        kw.setdefault("max_completion_tokens", 15000)
+        if route.effort:
+            kw.setdefault("reasoning_effort", route.effort)
+    return route, ResponseCache.key(route.deployments, messages, kw) if use_cache else None
+
+def _cache_answer(key: str | None, text: str, finish_reason: str | None, validate=None) -> None:
+    """Cache a complete answer (finish_reason "stop") that ``validate``, if given, accepts."""
+    if not key or not text or finish_reason != "stop":
+        return
+    if validate is not None:
+        try:
+            validate(text)
+        except ValueError:   # malformed structured output: let a retry ask again
+            return
+    RESPONSE_CACHE.put(key, text)
+
+def _create(stage: str, route: Route, messages, **kw):
+    """Create the completion on the first routed deployment that is neither throttled nor timing out."""
+    import openai
+
+    last = len(route.deployments) - 1
+    for i, deployment in enumerate(route.deployments):
+        client = _aoai_client() if i == last else _aoai_client().with_options(max_retries=0)
+        try:
+            return client.chat.completions.create(model=deployment, messages=messages, **kw)
+        except (openai.RateLimitError, openai.APITimeoutError):
+            if i == last:
+                raise
+            TELEMETRY.fallback(stage)
+
+def complete(stage: str, messages, **kw) -> str:
+    """
+    Run a chat completion on the deployments routed to ``stage``.
+
+    Deployments are tried in order; a throttled or timed-out call moves on
+    to the next one without the SDK's own retry back-off, except on the
+    last deployment, which keeps the default retries.
+
+    Results are memoised in RESPONSE_CACHE unless ``cache=False`` is passed
+    or the thread is inside ``cache_bypass()``. Only answers that finished
+    normally are stored, and with ``validate=fn`` only those ``fn`` parses
+    without raising ValueError, e.g. ``Model.model_validate_json``.
+    """
+    validate = kw.get("validate")
+    route, key = _prepare(stage, messages, kw)
+    if key:
+        text = RESPONSE_CACHE.get(key)
+        if text is not None:
+            TELEMETRY.memo_hit(stage)
+            return text
+    resp = _create(stage, route, messages, **kw)
+    TELEMETRY.record(stage, resp.usage)
+    text = resp.choices[0].message.content
+    _cache_answer(key, text, resp.choices[0].finish_reason, validate)
+    return text
+
+def complete_stream(stage: str, messages, **kw):
+    """
+    Like ``complete``, but yield the text in pieces as it is generated.
+
+    Falling back to another deployment is only possible before the first
+    token; a cached response is yielded in one piece.
+    """
+    validate = kw.get("validate")
+    route, key = _prepare(stage, messages, kw)
+    if key:
+        text = RESPONSE_CACHE.get(key)
+        if text is not None:
+            TELEMETRY.memo_hit(stage)
+            yield text
+            return
+    parts, finish_reason = [], None
+    with _create(stage, route, messages, stream=True, stream_options={"include_usage": True}, **kw) as stream:
+        for chunk in stream:
+            if chunk.usage:   # final chunk
+                TELEMETRY.record(stage, chunk.usage)
+            if chunk.choices:
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                if chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield parts[-1]
+    _cache_answer(key, "".join(parts), finish_reason, validate)
+
+def chat(messages, stage: str = "chat", **kw) -> str:
     """Return content of first OpenAI completion choice."""
-    client = AzureOpenAI(
-        azure_endpoint = os.environ['AOAI_ENDPOINT'],  
-        #   azure_ad_token_provider=token_provider,
-        api_version="2025-04-01-preview", # You must use this version or greater to access reasoning summary
-        api_key = os.environ['AOAI_KEY']
-        )
-    resp = client.chat.completions.create(model='o4-mini', messages=messages, max_completion_tokens=15000, **kw)
-    return resp.choices[0].message.content
+    return complete(stage, messages, **kw)
 
-async def invoke_agent(question, original_topic, agent_id):
+def reason(messages, stage: str = "reason", **kw) -> str:
+    """Return content of first reasoning-model completion choice."""
+    return complete(stage, messages, **kw)
 
-    project_endpoint = os.environ["PROJECT_ENDPOINT"]  # Ensure the PROJECT_ENDPOINT environment variable is set
-    if not agent_id:
-        agent_id = os.environ['AGENT_ID']
-    # Create an AIProjectClient instance
-    project_client = AIProjectClient(
-        endpoint=project_endpoint,
+def chat_stream(messages, stage: str = "chat", **kw):
+    """Yield the content of the first OpenAI completion choice as it is generated."""
+    return complete_stream(stage, messages, **kw)
+
+def embed(texts: Sequence[str]) -> np.ndarray:
+    """Return L2-normalised embeddings for ``texts`` as an (n, d) float32 matrix."""
+    import numpy as np
+
+    client = _aoai_client()
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = list(texts[start:start + EMBED_BATCH_SIZE])
+        resp = client.embeddings.create(model=EMBEDDING_MODEL, input=batch)
+        vectors.extend(d.embedding for d in sorted(resp.data, key=lambda d: d.index))
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.clip(norms, 1e-12, None)
+
+_BULLET = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+")
+
+def split_learnings(text: str) -> List[str]:
+    """Split a bulleted learnings summary into one string per bullet."""
+    bullets: List[str] = []
+    for line in text.splitlines():
+        if _BULLET.match(line):
+            bullets.append(_BULLET.sub("", line, count=1).strip())
+        elif line.strip() and bullets:
+            bullets[-1] += " " + line.strip()   # wrapped continuation of the previous bullet
+    return [b for b in bullets if b] or ([text.strip()] if text.strip() else [])
+
+class JsonArrayItems:
+    """
+    Incremental parser for a streamed JSON object: ``feed`` returns the items
+    of its top-level ``field`` array that were completed by the new text.
+    """
+
+    def __init__(self, field: str):
+        self._field = field
+        self.text = ""           # everything fed so far
+        self._pos = 0
+        self._depth = 0
+        self._in_string = self._escape = False
+        self._string_start = 0
+        self._key: str | None = None     # last string seen directly in the top-level object
+        self._array: int | None = None   # depth inside the field's array while it is open
+        self._done = False
+        self._item_start: int | None = None
+
+    def feed(self, text: str) -> list:
+        self.text += text
+        items = []
+        for i in range(self._pos, len(self.text)):
+            c = self.text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._array is None:
+                        self._key = self.text[self._string_start + 1:i]
+                    elif self._depth == self._array and self._item_start is not None:   # string item
+                        items.append(self.text[self._item_start:i + 1])
+                        self._item_start = None
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+                if self._depth == self._array and self._item_start is None:
+                    self._item_start = i
+            elif c in "{[":
+                if self._depth == self._array and self._item_start is None:
+                    self._item_start = i
+                self._depth += 1
+                if c == "[" and self._depth == 2 and self._key == self._field and not self._done:
+                    self._array = 2
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == self._array and self._item_start is not None:   # object or array item
+                    items.append(self.text[self._item_start:i + 1])
+                    self._item_start = None
+                elif self._array is not None and self._depth < self._array:      # the field's array closed
+                    self._array, self._done = None, True
+        self._pos = len(self.text)
+        return [json.loads(raw) for raw in items]
+
+@lru_cache(maxsize=None)
+def _project_client() -> AIProjectClient:
+    """Shared Azure AI Foundry project client; the credential caches its tokens."""
+    from azure.ai.projects import AIProjectClient
+    from azure.identity import DefaultAzureCredential
+    return AIProjectClient(
+        endpoint=os.environ["PROJECT_ENDPOINT"],  # Ensure the PROJECT_ENDPOINT environment variable is set
         credential=DefaultAzureCredential(),  # Use Azure Default Credential for authentication
     )
-    # Call agent
-    thread = project_client.agents.threads.create()
-    message = project_client.agents.messages.create(
-        thread_id=thread.id,
-        role=MessageRole.USER,
-        content=f'Topic: {original_topic}\nQuestion: {question}',
+
+class ThreadJanitor:
+    """Counts agent threads and deletes finished ones off the request path."""
+
+    def __init__(self, keep: bool = False, workers: int = CLEANUP_THREADS):
+        self._keep = keep
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thread-cleanup")
+        self._lock = threading.Lock()
+        self._counts = {"created": 0, "released": 0, "deleted": 0, "delete_failures": 0}
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counts[key] += 1
+
+    def created(self) -> None:
+        self._count("created")
+
+    def release(self, thread_id: str) -> None:
+        """The run on ``thread_id`` is finished and its messages have been read."""
+        self._count("released")
+        if not self._keep:
+            self._pool.submit(self._delete, thread_id)
+
+    def _delete(self, thread_id: str) -> None:
+        try:
+            _project_client().agents.threads.delete(thread_id)
+        except Exception:
+            self._count("delete_failures")
+        else:
+            self._count("deleted")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        counts["live"] = counts["created"] - counts["deleted"]       # still stored in the project
+        counts["in_use"] = counts["created"] - counts["released"]    # runs in progress
+        counts["pending_deletes"] = 0 if self._keep else counts["released"] - counts["deleted"] - counts["delete_failures"]
+        return counts
+
+THREAD_JANITOR = ThreadJanitor(keep=AGENT_THREAD_CLEANUP == "keep")
+
+async def invoke_agent(question, original_topic, agent_id, sources: SourceRegistry | None = None):
+    """Run the research agent and summarise its answer, citing sources as ``[n]`` ids from ``sources``."""
+    from azure.ai.agents.models import AgentThreadCreationOptions, MessageRole, ThreadMessageOptions
+
+    sources = sources if sources is not None else SourceRegistry()
+
+    if not agent_id:
+        agent_id = os.environ['AGENT_ID']
+    project_client = _project_client()
+    # Call agent: thread, question and run in one round trip
+    run = project_client.agents.create_thread_and_process_run(
+        agent_id=agent_id,
+        thread=AgentThreadCreationOptions(messages=[ThreadMessageOptions(
+            role=MessageRole.USER,
+            content=f'Topic: {original_topic}\nQuestion: {question}',
+        )]),
     )
+    THREAD_JANITOR.created()
+    try:
+        if run.status != "completed":
+            return None
+        m = project_client.agents.messages.get_last_message_by_role(thread_id=run.thread_id, role=MessageRole.AGENT)
+    finally:
+        THREAD_JANITOR.release(run.thread_id)
+    updated_text = "".join(entity.text.value for entity in m.content if entity.type == 'text')
+
+    # Swap every citation placeholder for its compact source id in a single pass
+    markers = {}
+    for citation in (x.as_dict() for x in m.url_citation_annotations):
+        source = citation['url_citation']
+        markers[citation['text']] = f"[{sources.register(source['url'], source.get('title', ''))}]"
+    if markers:
+        pattern = re.compile("|".join(map(re.escape, sorted(markers, key=len, reverse=True))))
+        updated_text = pattern.sub(lambda match: markers[match.group(0)], updated_text)
+
+    # Summarize the key learnings
+    messages = [{'role': 'system', 'content': SUMMARIZE_PROMPT},
+                {'role': 'user', 'content': f'## QUESTION: {question}\n\n## RESEARCH OUTPUT: {json.dumps(updated_text)}'}]
+
+    return chat(messages, stage="summarize", temperature=0.0, max_tokens=2000)
+
+class AgentStats:
+    """Recent per-agent latencies and outcomes, used to rank agents and time hedges."""
 
-    run = project_client.agents.runs.create_and_process(thread_id=thread.id, agent_id=agent_id)
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._window = window
+        self._latencies: dict[str, deque] = {}
+        self._counts: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
 
-    if run.status == "completed":
-        m = project_client.agents.messages.get_last_message_by_role(thread_id=thread.id, role=MessageRole.AGENT)
-        citations = m.url_citation_annotations
-        if len(citations) > 0:
-            citations = [x.as_dict() for x in citations]
+    def _count(self, agent_id: str, key: str) -> None:
+        row = self._counts.setdefault(agent_id, {"runs": 0, "failures": 0, "hedges": 0, "hedge_wins": 0})
+        row[key] += 1
 
-        updated_text = ''
-        if len(m.content) > 0:
-            for entity in m.content:
-                if entity.type=='text':
-                    updated_text += entity.text.value
-        for citation in citations:
-            formatted_citation = f"[{citation['url_citation']['title']}]({citation['url_citation']['url']}) "
-            updated_text = updated_text.replace(citation['text'], formatted_citation)
+    def record(self, agent_id: str, seconds: float) -> None:
+        with self._lock:
+            self._latencies.setdefault(agent_id, deque(maxlen=self._window)).append(seconds)
+            self._count(agent_id, "runs")
 
-        # out_messages = [msg for msg in out_messages]
+    def failure(self, agent_id: str) -> None:
+        with self._lock:
+            self._count(agent_id, "failures")
 
+    def hedged(self, agent_id: str) -> None:
+        """``agent_id`` was slow or failed and a backup run was started."""
+        with self._lock:
+            self._count(agent_id, "hedges")
+
+    def hedge_won(self, agent_id: str) -> None:
+        """A backup run on ``agent_id`` answered first."""
+        with self._lock:
+            self._count(agent_id, "hedge_wins")
+
+    def percentile(self, agent_id: str, p: float) -> float | None:
+        with self._lock:
+            samples = sorted(self._latencies.get(agent_id, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    def hedge_delay(self, agent_id: str) -> float:
+        """Seconds to wait for ``agent_id`` before starting a backup run."""
+        with self._lock:
+            enough = len(self._latencies.get(agent_id, ())) >= HEDGE_MIN_SAMPLES
+        return self.percentile(agent_id, HEDGE_PERCENTILE) if enough else HEDGE_DEFAULT_DELAY
+
+    def rank(self, agent_ids: Sequence[str]) -> List[str]:
+        """Agents fastest first, by median latency inflated by failure rate; unseen agents first to explore them."""
+        def cost(agent_id):
+            with self._lock:
+                row = self._counts.get(agent_id, {"runs": 0, "failures": 0})
+            if not row["runs"] + row["failures"]:
+                return 0.0
+            success = row["runs"] / (row["runs"] + row["failures"])
+            median = self.percentile(agent_id, 0.5)
+            if median is None:   # only failures so far
+                median = HEDGE_DEFAULT_DELAY
+            return median / max(success, 0.1)
+        return sorted(dict.fromkeys(agent_ids), key=cost)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            agents = {a: dict(c) for a, c in self._counts.items()}
+        for agent_id, row in agents.items():
+            row.update({f"p{int(p * 100)}_seconds": self.percentile(agent_id, p) for p in (0.5, HEDGE_PERCENTILE)})
+        return agents
+
+AGENT_STATS = AgentStats()
+
+def _spawn(fn, *args) -> Future:
+    """
+    Run ``fn(*args)`` on a new daemon thread. Agent attempts are not pooled:
+    the node threads that start them already bound how many run, and a
+    losing attempt that is still running must not delay anyone's primary.
+    """
+    fut = Future()
+
+    def run():
+        fut.set_running_or_notify_cancel()
+        try:
+            fut.set_result(fn(*args))
+        except BaseException as exc:
+            fut.set_exception(exc)
+
+    threading.Thread(target=run, name="agent", daemon=True).start()
+    return fut
+
+def invoke_agents(question, original_topic, agent_ids: Sequence[str], hedge: bool = True, on_late_usage=None):
+    """
+    Research ``question`` with the best agent of a pool, hedging slow runs.
+
+    Returns ``(summary, sources, agent_id)`` from the first attempt that
+    succeeds. A backup attempt starts when the primary is slower than its
+    hedge delay or fails. Tokens of attempts that end before this returns
+    count towards the caller's ``track_usage`` scope. Losing attempts run
+    to completion in the background; their tokens are passed to
+    ``on_late_usage(totals)`` when they finish.
+    """
+    ranked = AGENT_STATS.rank([a or os.environ['AGENT_ID'] for a in agent_ids or [""]])
+    primary = ranked[0]
+    backups = list((ranked[1:] or ranked)[:HEDGE_MAX_BACKUPS]) if hedge else []
+    usage = getattr(_usage_scope, "totals", None)
+    bypass = getattr(_cache_scope, "bypass", False)
+    lock = threading.Lock()
+    returned = False   # set once the caller has its answer
+
+    def settle(totals: dict) -> None:
+        """Add an attempt's tokens to the caller's scope, or report them late."""
+        with lock:
+            late = returned
+            if not late and usage is not None:
+                for key, value in totals.items():
+                    usage[key] += value
+        if late and on_late_usage is not None and any(totals.values()):
+            on_late_usage(totals)
+
+    def attempt(agent_id):
+        sources = SourceRegistry()
+        started = time.monotonic()
+        with track_usage() as totals, cache_bypass(bypass):
+            try:
+                text = asyncio.run(invoke_agent(question, original_topic, agent_id, sources))
+            except Exception:
+                AGENT_STATS.failure(agent_id)
+                raise
+            finally:
+                settle(totals)
+        if text is None:
+            AGENT_STATS.failure(agent_id)
+            raise RuntimeError(f"agent run did not complete ({agent_id})")
+        AGENT_STATS.record(agent_id, time.monotonic() - started)
+        return text, sources, agent_id
+
+    def finish():
+        nonlocal returned
+        with lock:
+            returned = True
+
+    first = _spawn(attempt, primary)
+    pending = {first}
+    error: BaseException | None = None
+    while pending:
+        done, pending = wait(pending, timeout=AGENT_STATS.hedge_delay(primary) if backups else None,
+                             return_when=FIRST_COMPLETED)
+        for fut in done:
+            if fut.exception() is None:
+                if fut is not first:
+                    AGENT_STATS.hedge_won(fut.result()[2])
+                finish()
+                return fut.result()
+            error = fut.exception()
+        if backups and (not done or not pending):   # primary is slow, or everything in flight failed
+            AGENT_STATS.hedged(primary)
+            pending.add(_spawn(attempt, backups.pop(0)))
+    finish()
+    raise error
+
+def warm_up(agent_ids: Sequence[str] | None = None) -> dict:
+    """
+    Do a first request's one-off work ahead of time: import the SDKs, open
+    the Azure OpenAI connection pool, and fetch a Foundry token while
+    looking up each agent. Returns seconds, or the error, per step; never raises.
+    """
+    agent_ids = [a for a in dict.fromkeys(agent_ids or AGENT_POOL or [os.getenv("AGENT_ID", "")]) if a]
+    steps: dict[str, float | str] = {}
+
+    def step(name: str, fn) -> None:
+        started = time.monotonic()
+        try:
+            fn()
+            steps[name] = round(time.monotonic() - started, 3)
+        except Exception as exc:
+            steps[name] = repr(exc)
+
+    step("imports", lambda: (__import__("numpy"), __import__("azure.ai.agents.models")))
+    step("openai", lambda: _aoai_client().models.list())
+    for agent_id in agent_ids:
+        step(f"agent:{agent_id}", lambda: _project_client().agents.get_agent(agent_id))
+    return steps
 
-        # Summarize the key learnings
-        messages = [{'role': 'system', 'content': f'You review output from a researcher on a given topic and distill succinct learnings. These learnings should be no more than 5 **very detailed** bullet points containing the most relevant information obtained. These bullets should contain sufficient detail and EACH BULLET SHOULD CONTAIN A SOURCE CITATION. **IMPORTANT:** Your source citations should retain the citation format from the initial research, often a website title with URL. **DO NOT** include a list of sources separate from the bulleted learnings. Your learnings should be relevant to the following question: {question}'},
-                    {'role': 'user', 'content': json.dumps(updated_text)}]
-        
-        response = chat(messages, temperature=0.0, max_tokens=2000)
-    
-        return response
 
 # --------------------------------------------------------------------- #
 # 2️⃣  Pydantic + dataclasses
@@ -116,22 +837,583 @@ class Processed(BaseModel):
     learnings: List[str] = Field(default_factory=list)
     follow_up_questions: List[str] = Field(default_factory=list)
 
+class Section(BaseModel):
+    title: str
+    focus: str
+
+class Outline(BaseModel):
+    sections: List[Section]
+
+class ReportPart(NamedTuple):
+    """A piece of a sectioned report: kind is "outline", "section", "summary" or "sources"."""
+    kind: str
+    index: int | None
+    title: str | None
+    text: str
+
+# Legacy text/plain rendering of each event type (HTML snippets rendered by the Streamlit app)
+_TEXT_TEMPLATES = {
+    "status": "{text}<br/><br/>",
+    "phase": "<h2>{text}</h2><br/><br/>",
+    "node": "<span style='color:dodgerblue;'><b>Research Topic: </b></span>{title}<br/><span style='color:limegreen;'><b>Learnings:</b></span><br/>&emsp; • {text}<br/><br/>",
+    "error": "⚠️ {text}<br/><br/>",
+    "outline": "",
+    "quota": "",
+    "section": "{text}\n\n",
+    "summary": "{text}\n\n",
+    "sources": "{text}\n",
+    "report": "{text}\n",
+}
+
+@dataclass
+class Event:
+    """One streamed update, rendered as a legacy text chunk or as an NDJSON line."""
+    type: str                   # a key of _TEXT_TEMPLATES
+    text: str
+    id: str | int | None = None  # node id or section index
+    title: str | None = None     # node query or section title
+
+    def render(self, stream_format: str) -> str:
+        if stream_format == "events":
+            return json.dumps(asdict(self), ensure_ascii=False) + "\n"
+        return _TEXT_TEMPLATES[self.type].format(text=self.text, title=self.title)
+
+class EventBuffer:
+    """
+    Bounded, ordered buffer of rendered chunks between a session and its response.
+
+    ``put`` blocks while more than ``max_bytes`` are queued, except for
+    LOW_PRIORITY_EVENTS, which replace a queued chunk of the same type
+    instead of adding another. Chunks over ``spill_bytes`` are kept in a
+    temporary file until the client reaches them. Iterating yields chunks
+    until ``finish()``; closing the iterator (client gone) releases blocked
+    producers and discards the rest. If a blocked ``put`` sees the client
+    read nothing for ``stall_seconds``, it closes the buffer the same way.
+    """
+
+    def __init__(self, max_bytes: int = EVENT_BUFFER_BYTES, spill_bytes: int = EVENT_SPILL_BYTES,
+                 stall_seconds: float = EVENT_STALL_SECONDS):
+        self._max_bytes = max_bytes
+        self._spill_bytes = spill_bytes
+        self._stall_seconds = stall_seconds
+        self._reads = 0                       # chunks taken by the client, to tell slow from stalled
+        self._chunks: deque[list] = deque()   # [chunk or spilled file, bytes held in memory, type]
+        self._progress: dict[str, list] = {}  # queued low-priority entry per type
+        self._bytes = 0
+        self._finished = False
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, type: str, chunk: str) -> None:
+        low = type in LOW_PRIORITY_EVENTS
+        payload, size = chunk, len(chunk)
+        if not low and size > self._spill_bytes:
+            payload = tempfile.TemporaryFile("w+", encoding="utf-8")
+            payload.write(chunk)
+            size = 0
+        with self._cond:
+            if low and type in self._progress:   # the client only needs the latest progress
+                entry = self._progress[type]
+                self._bytes += size - entry[1]
+                entry[0], entry[1] = payload, size
+                return
+            reads, deadline = self._reads, time.monotonic() + self._stall_seconds
+            while not low and not self._closed and self._bytes and self._bytes + size > self._max_bytes:
+                if self._reads != reads:   # still reading, just slowly
+                    reads, deadline = self._reads, time.monotonic() + self._stall_seconds
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.close()   # stalled: drop the client rather than hold a node thread
+                    break
+                self._cond.wait(remaining)
+            if self._closed:
+                if not isinstance(payload, str):
+                    payload.close()
+                return
+            entry = [payload, size, type]
+            self._chunks.append(entry)
+            self._bytes += size
+            if low:
+                self._progress[type] = entry
+            self._cond.notify_all()
+
+    def finish(self) -> None:
+        """No more chunks will be put; iteration ends once the buffer is drained."""
+        with self._cond:
+            self._finished = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        """True once the client has gone or stalled; further chunks are dropped."""
+        return self._closed
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = self._finished = True
+            for payload, _size, _type in self._chunks:
+                if not isinstance(payload, str):
+                    payload.close()
+            self._chunks.clear()
+            self._progress.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+
+    def __iter__(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._chunks and not self._finished:
+                        self._cond.wait()
+                    if not self._chunks:
+                        return
+                    entry = self._chunks.popleft()
+                    if self._progress.get(entry[2]) is entry:
+                        del self._progress[entry[2]]
+                    self._bytes -= entry[1]
+                    self._reads += 1
+                    self._cond.notify_all()
+                payload = entry[0]
+                if not isinstance(payload, str):
+                    with payload:
+                        payload.seek(0)
+                        payload = payload.read()
+                yield payload
+        finally:
+            self.close()
+
+_WORD = re.compile(r"[^\W\d_]{3,}")   # words of three or more letters; skips [n] markers and numbers
+
+def _words(text: str) -> set[str]:
+    return {w.lower() for w in _WORD.findall(text)}
+
+class LearningStore:
+    """
+    Learnings backed by a NumPy embedding matrix.
+
+    New learnings are embedded in one batch and dropped when their cosine
+    similarity to a stored learning (or an earlier one in the same batch)
+    exceeds ``threshold``.  ``top_k`` ranks stored learnings against any
+    text, e.g. the original question or a report section heading.  Without
+    an ``embed_fn``, or once an embeddings call has failed, the store falls
+    back to exact-match dedup, and ``top_k`` returns every learning in
+    insertion order, since there is nothing to rank by.
+    """
+
+    def __init__(self, embed_fn=None, threshold: float = DEDUP_THRESHOLD):
+        self._embed = embed_fn
+        self._threshold = threshold
+        self._texts: List[str] = []
+        self._matrix: np.ndarray | None = None   # (n, d) normalised embeddings, row i ↔ _texts[i]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def __iter__(self):
+        return iter(list(self._texts))
+
+    @property
+    def ranked(self) -> bool:
+        """True while ``top_k`` ranks learnings by embedding similarity."""
+        return self._embed is not None
+
+    def _disable(self, exc: Exception) -> None:
+        """Stop embedding after a failed call, e.g. a missing deployment; stored vectors no longer match _texts."""
+        with self._lock:
+            if self._embed is None:
+                return
+            self._embed, self._matrix = None, None
+        print(f"Embeddings unavailable, using exact-match dedup and insertion order: {exc!r}")
+
+    def extend(self, texts: Sequence[str]) -> List[str]:
+        """Add ``texts``, skipping near-duplicates; return the ones kept."""
+        with self._lock:
+            seen = set(self._texts)
+        candidates = [t for t in dict.fromkeys(t.strip() for t in texts) if t and t not in seen]
+        if not candidates:
+            return []
+        vectors = None
+        if self._embed is not None:
+            try:
+                vectors = self._embed(candidates)   # network call stays outside the lock
+            except Exception as exc:
+                self._disable(exc)
+
+        kept, kept_rows = [], []
+        with self._lock:
+            if vectors is None or self._embed is None:   # no embeddings, or disabled by another thread meanwhile
+                kept = [t for t in candidates if t not in self._texts]
+                self._texts.extend(kept)
+                return kept
+            import numpy as np
+
+            for text, vec in zip(candidates, vectors):
+                if self._matrix is not None and float((self._matrix @ vec).max()) >= self._threshold:
+                    continue
+                if kept_rows and float((np.stack(kept_rows) @ vec).max()) >= self._threshold:
+                    continue
+                kept.append(text)
+                kept_rows.append(vec)
+            if kept:
+                block = np.stack(kept_rows)
+                self._matrix = block if self._matrix is None else np.vstack([self._matrix, block])
+                self._texts.extend(kept)
+        return kept
+
+    def add(self, text: str) -> bool:
+        return bool(self.extend([text]))
+
+    def top_k(self, query: str, k: int) -> List[str]:
+        """Return up to ``k`` learnings ranked by cosine similarity to ``query`` (all of them without embeddings)."""
+        return self.top_k_many([query], k)[0]
+
+    def top_k_many(self, queries: Sequence[str], k: int) -> List[List[str]]:
+        """Rank learnings against several queries with one embeddings call."""
+        with self._lock:
+            texts, matrix = list(self._texts), self._matrix
+        if self._embed is None or matrix is None or not texts:
+            return [list(texts) for _ in queries]
+        import numpy as np
+
+        try:
+            scores = self._embed(list(queries)) @ matrix.T
+        except Exception as exc:
+            self._disable(exc)
+            return [list(texts) for _ in queries]
+        k = min(k, len(texts))
+        out = []
+        for row in scores:
+            idx = np.argpartition(-row, k - 1)[:k]
+            out.append([texts[i] for i in idx[np.argsort(-row[idx])]])
+        return out
+
+    def top_k_lexical(self, queries: Sequence[str], k: int) -> List[List[str]]:
+        """
+        Rank learnings against several queries by the words they share,
+        weighted by rarity (IDF), for when there are no embeddings. Each
+        query gets up to ``k`` learnings that share a word with it, or every
+        learning if none does.
+        """
+        import math
+
+        texts = list(self)
+        words = [_words(t) for t in texts]
+        df: dict[str, int] = {}
+        for ws in words:
+            for w in ws:
+                df[w] = df.get(w, 0) + 1
+        out = []
+        for query in queries:
+            wanted = _words(query)
+            scores = [sum(math.log(len(texts) / df[w]) + 1 for w in wanted & ws) for ws in words]
+            best = sorted((i for i, score in enumerate(scores) if score), key=lambda i: -scores[i])[:k]
+            out.append([texts[i] for i in best] or texts)
+        return out
+
+
+_TRACKING_PARAM = re.compile(r"^(utm_\w+|fbclid|gclid|msclkid|mc_cid|mc_eid|ref_src)$", re.IGNORECASE)
+_MARKER = re.compile(r"\[(\d+(?:\s*,\s*\d+)*)\](?!\()")   # [3] or [3, 5], but not a link label [3](...)
+
+def canonical_url(url: str) -> str:
+    """Normalise a URL for dedup: lower-case host without www., no default port, fragment or tracking params."""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower().removeprefix("www.")
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host if port in (None, 80, 443) else f"{host}:{port}"
+    path = re.sub(r"/{2,}", "/", parts.path).rstrip("/")
+    query = urlencode(sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not _TRACKING_PARAM.match(k)))
+    return urlunsplit(((parts.scheme or "https").lower(), netloc, path, query, ""))
+
+
+class SourceRegistry:
+    """
+    Deduplicated sources with compact numeric ids.
+
+    URLs are keyed on their canonical form without the scheme, so http/https,
+    www., tracking-parameter and trailing-slash variants share one id; the
+    first URL seen for an id is the one linked to, unchanged. Text
+    refers to sources as ``[n]``; ``linkify`` turns the markers into
+    clickable links and ``bibliography`` lists them.
+    """
+
+    def __init__(self):
+        self._ids: dict[str, int] = {}
+        self._entries: List[dict] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def register(self, url: str, title: str = "") -> int:
+        """Return the id for ``url``, adding it if it is new."""
+        return self._register(url, title)[0]
+
+    def _register(self, url: str, title: str) -> tuple[int, bool]:
+        url = url.strip()
+        key = canonical_url(url).split("://", 1)[-1]
+        with self._lock:
+            if key in self._ids:
+                return self._ids[key], False
+            self._entries.append({"id": len(self._entries) + 1, "url": url, "title": title or url})
+            self._ids[key] = len(self._entries)
+            return self._ids[key], True
+
+    def entries(self) -> List[dict]:
+        with self._lock:
+            return [dict(e) for e in self._entries]
+
+    def merge(self, text: str, entries: Sequence[dict]) -> tuple[str, int]:
+        """
+        Register another registry's ``entries`` and rewrite ``text``'s markers
+        to this registry's ids. Markers that are not in ``entries`` are
+        dropped, so they can never link to an unrelated source. Returns the
+        text and how many entries were new.
+        """
+        mapping, new = {}, 0
+        for e in entries:
+            mapping[e["id"]], is_new = self._register(e["url"], e["title"])
+            new += is_new
+
+        def remap(match):
+            ids = [str(mapping[int(i)]) for i in match.group(2).split(",") if int(i) in mapping]
+            return match.group(1) + "[" + ", ".join(ids) + "]" if ids else ""
+
+        text = re.sub(r"([ \t]*)" + _MARKER.pattern, remap, text)
+        return text, new
+
+    def linkify(self, text: str) -> str:
+        """Replace ``[n]`` markers with markdown links to the sources."""
+        with self._lock:
+            urls = {e["id"]: e["url"] for e in self._entries}
+
+        def link(match):
+            ids = [int(i) for i in match.group(1).split(",")]
+            if not all(i in urls for i in ids):
+                return match.group(0)
+            return "".join(f"[[{i}]]({urls[i]})" for i in ids)
+
+        return _MARKER.sub(link, text)
+
+    def bibliography(self, text: str | None = None) -> str:
+        """Markdown list of the sources cited in ``text`` (all sources when omitted)."""
+        cited = None
+        if text is not None:
+            cited = {int(i) for m in re.finditer(r"\[\[?(\d+(?:\s*,\s*\d+)*)\]", text) for i in m.group(1).split(",")}
+        rows = [e for e in self.entries() if cited is None or e["id"] in cited]
+        if not rows:
+            return ""
+        return "## Sources\n" + "\n".join(f"{e['id']}. [{e['title']}]({e['url']})" for e in rows)
+
+
 @dataclass
 class State:
-    learnings: List[str] = field(default_factory=list)
-    sources: List[str] = field(default_factory=list)
+    learnings: LearningStore = field(default_factory=lambda: LearningStore(embed if EMBEDDING_MODEL else None))
+    sources: SourceRegistry = field(default_factory=SourceRegistry)
+
+
+@dataclass(frozen=True)
+class NodeRecord:
+    """One researched node. Records are immutable and appended when the node finishes."""
+    id: str
+    parent: str | None
+    level: int                       # 1 for the initial questions
+    query: str
+    started_at: float
+    finished_at: float
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    learnings: str | None = None
+    citations: tuple[str, ...] = ()
+    follow_ups: tuple[str, ...] = ()
+    agent: str | None = None         # agent whose answer was used
+    novelty: float | None = None     # adaptive mode only
+    error: str | None = None
+
+    @classmethod
+    def from_result(cls, result: dict) -> "NodeRecord":
+        """Build a record from a ``run_task`` result."""
+        return cls(
+            id=result["node"], parent=result.get("parent"), level=result["level"], query=result["query"],
+            started_at=result["started_at"], finished_at=result["finished_at"],
+            prompt_tokens=result["prompt_tokens"], cached_tokens=result["cached_tokens"],
+            completion_tokens=result["completion_tokens"], learnings=result["learnings"],
+            citations=tuple(result["citations"]), follow_ups=tuple(result["follow_up_questions"]),
+            agent=result.get("agent"), novelty=result.get("novelty"), error=result["error"],
+        )
+
+
+@dataclass
+class ResearchSession(State):
+    """
+    State of one research run, safe to share between worker threads.
+
+    Every node is ``begin``-ed when it is scheduled and ``record``-ed exactly
+    once when it finishes (successfully or not), so ``wait_idle`` returns
+    only when no node is queued or running. A node must schedule its
+    follow-ups before it is recorded.
+    """
+    query: str = ""
+    tenant: str = "default"
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    created_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+    report: str | None = None   # final report, including its sources list
+    cancelled: bool = False     # set when nobody will read the result; queued nodes are skipped
+    _nodes: List[NodeRecord] = field(default_factory=list, repr=False)
+    _queries: set = field(default_factory=set, repr=False)
+    _pending: int = field(default=0, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        self._idle = threading.Condition(self._lock)
+
+    def claim(self, query: str) -> bool:
+        """Return False if ``query`` was already scheduled in this session."""
+        with self._lock:
+            if query in self._queries:
+                return False
+            self._queries.add(query)
+            return True
+
+    def begin(self) -> None:
+        with self._lock:
+            self._pending += 1
+
+    def record(self, node: NodeRecord) -> None:
+        with self._lock:
+            self._nodes.append(node)
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return self._pending
+
+    def wait_idle(self, timeout: float | None = None) -> bool:
+        with self._lock:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def nodes(self) -> List[NodeRecord]:
+        with self._lock:
+            return list(self._nodes)
+
+    def tree(self) -> dict:
+        """Export the session as a nested research tree with totals."""
+        nodes = self.nodes()
+        children: dict[str | None, list[dict]] = {}
+        for node in nodes:
+            row = asdict(node)
+            row["seconds"] = round(node.finished_at - node.started_at, 3)
+            row["children"] = children.setdefault(node.id, [])
+            children.setdefault(node.parent, []).append(row)
+        return {
+            "id": self.id,
+            "query": self.query,
+            "tenant": self.tenant,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "cancelled": self.cancelled,
+            "pending": self.pending,
+            "totals": {
+                "nodes": len(nodes),
+                "failed": sum(1 for n in nodes if n.error),
+                "prompt_tokens": sum(n.prompt_tokens for n in nodes),
+                "cached_tokens": sum(n.cached_tokens for n in nodes),
+                "completion_tokens": sum(n.completion_tokens for n in nodes),
+                "learnings": len(self.learnings),
+                "sources": len(self.sources),
+            },
+            "sources": self.sources.entries(),
+            "children": children.get(None, []),
+        }
+
+
+class SessionRegistry:
+    """The most recent ``limit`` sessions, by id."""
+
+    def __init__(self, limit: int = MAX_SESSIONS):
+        self._limit = limit
+        self._sessions: OrderedDict[str, ResearchSession] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, session: ResearchSession) -> None:
+        with self._lock:
+            self._sessions[session.id] = session
+            while len(self._sessions) > self._limit:
+                self._sessions.popitem(last=False)
+
+    def get(self, session_id: str) -> ResearchSession | None:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+SESSIONS = SessionRegistry()
+
+
+def novelty(new_facts: int, facts: int, new_sources: int, sources: int) -> float:
+    """Information gain of a node: the share of its facts (and, if it cites any, sources) that are new."""
+    fact_gain = new_facts / facts if facts else 0.0
+    if not sources:
+        return fact_gain
+    return 0.5 * fact_gain + 0.5 * new_sources / sources
+
+
+class AdaptiveController:
+    """
+    Expand, narrow or terminate branches by novelty within a node budget.
+
+    A node scoring at least ``expand`` keeps all its follow-ups, one below
+    ``stop`` keeps none, and in between the count scales linearly. Every
+    scheduled node takes one unit of the shared ``max_nodes`` budget.
+    """
+
+    def __init__(self, max_nodes: int, max_follow_ups: int = ADAPTIVE_MAX_FOLLOW_UPS,
+                 expand: float = NOVELTY_EXPAND, stop: float = NOVELTY_STOP):
+        self.max_follow_ups = max_follow_ups
+        self._expand, self._stop = expand, stop
+        self._remaining = max_nodes
+        self._lock = threading.Lock()
+
+    def follow_ups(self, score: float) -> int:
+        """How many follow-ups a node with this novelty should get, before the budget."""
+        if score < self._stop:
+            return 0
+        if score >= self._expand:
+            return self.max_follow_ups
+        scaled = round(self.max_follow_ups * (score - self._stop) / (self._expand - self._stop))
+        return min(self.max_follow_ups - 1, max(1, scaled))
+
+    def reserve(self, n: int) -> int:
+        """Take up to ``n`` nodes from the budget; returns how many were granted."""
+        with self._lock:
+            granted = max(0, min(n, self._remaining))
+            self._remaining -= granted
+            return granted
+
+    def release(self, n: int) -> None:
+        with self._lock:
+            self._remaining += n
 
 # --------------------------------------------------------------------- #
 # 3️⃣  LLM steps
 # --------------------------------------------------------------------- #
-async def make_queries(prompt: str, k: int, prior: Sequence[str] | None, system_prompt=''):
+def stream_queries(prompt: str, k: int, prior: Sequence[str] | None):
+    """Yield up to ``k`` research queries, each as soon as the model has finished writing it."""
     block = ("\nHere are previous learnings:\n" + "\n".join(prior)) if prior else ""
-    raw = chat(
+    stream = chat_stream(
         [
-            {"role": "system", "content": "You generate research inquiries based on a research topic or question. You should generate unique questions that are relevant to the topic and can be asked of a subject matter expert."},
+            {"role": "system", "content": QUERIES_PROMPT},
             {"role": "user",
-             "content": f"Generate ≤{k} UNIQUE questions about the research topic or question presented here. These questions should be framed as though they were being asked of a subject matter expert in the area.\n## TOPIC/QUESTION: {prompt}</prompt>{block}."}
+             "content": f"## TOPIC/QUESTION: {prompt}{block}\n\nNumber of questions: ≤{k}"}
         ],
+        stage="queries",
+        validate=QueryList.model_validate_json,
         temperature=0.0,
         max_tokens=800,
         response_format = {
@@ -161,23 +1443,30 @@ async def make_queries(prompt: str, k: int, prior: Sequence[str] | None, system_
         }
 
     )
-    parsed = QueryList.model_validate_json(raw)
-    for q in parsed.queries:
-        print('Query: ' + q.query)
-        print()
-        # pass
-    return QueryList.model_validate_json(raw).queries[:k]
-
-async def distil(query: str, docs, n_learn=3, n_q=3):
-    # print(docs)
+    parser, count = JsonArrayItems("queries"), 0
+    for delta in stream:
+        for item in parser.feed(delta):
+            count += 1
+            if count <= k:
+                q = Query.model_validate(item)
+                print('Query: ' + q.query)
+                print()
+                yield q
+    if not count:
+        QueryList.model_validate_json(parser.text)   # raise on a malformed response rather than research nothing
+
+def stream_follow_ups(query: str, docs, n_q=3, fast: bool = False):
+    """Yield follow-up questions for a researched node, each as soon as the model has finished writing it."""
     content = docs
-    raw = chat(
+    stream = chat_stream(
         [
-            {"role": "system", "content": 'You generate follow up questions for a research topic or question based on learnings from previous research.'},
+            {"role": "system", "content": DISTIL_PROMPT},
             {"role": "user",
-             "content": f"Generate {n_q} follow‑up questions for this question ## QUESTION: {query}\n\n These follow ups should be based on the following learnings.:\n{content}"},
+             "content": f"## QUESTION: {query}\n\n## LEARNINGS:\n{content}\n\nNumber of follow-up questions: {n_q}"},
              
         ],
+        stage="distil_fast" if fast else "distil",
+        validate=Processed.model_validate_json,
         temperature=0.0,
         max_tokens=2000,
         response_format = {
@@ -200,11 +1489,16 @@ async def distil(query: str, docs, n_learn=3, n_q=3):
         }
 
     )
+    parser, count = JsonArrayItems("follow_up_questions"), 0
+    for delta in stream:
+        for question in parser.feed(delta):
+            count += 1
+            yield question
+    if not count:
+        Processed.model_validate_json(parser.text)   # raise on a malformed response; an empty list is fine
 
-    return Processed.model_validate_json(raw)
 
-
-async def final_report(prompt: str, learnings: Sequence[str], sources: Sequence[str], system_prompt=''):
+async def final_report(prompt: str, learnings: Sequence[str], sources: SourceRegistry, system_prompt=''):
     # print(len(learnings))
     # print(learnings)
     block = "\n".join(f"<l>{l}</l>" for l in learnings)
@@ -212,56 +1506,724 @@ async def final_report(prompt: str, learnings: Sequence[str], sources: Sequence[
         [
             {"role": "system", "content": system_prompt},
             {"role": "user",
-             "content": f"## Original Research Question/Topic: {prompt}\n\n##Research learnings: {block}"},
+             "content": f"{CITATION_NOTE}\n\n## Original Research Question/Topic: {prompt}\n\n##Research learnings: {block}"},
         ],
+        stage="report",
         # response_format={"type": "json_object"},
-        reasoning_effort="medium"
     )
     body = raw
-    return body
-    # return body + "\n\n## Sources\n" + "\n".join(f"- `{s}`" for s in sources)
+    return sources.linkify(body) + "\n\n" + sources.bibliography(body)
+
+async def make_outline(prompt: str, learnings: Sequence[str], max_sections: int = REPORT_SECTIONS) -> List[Section]:
+    block = "\n".join(f"<l>{l}</l>" for l in learnings)
+    raw = chat(
+        [
+            {"role": "system", "content": OUTLINE_PROMPT},
+            {"role": "user",
+             "content": f"## QUESTION: {prompt}\n\n## Learnings:\n{block}\n\nNumber of sections: ≤{max_sections}"},
+        ],
+        stage="outline",
+        validate=Outline.model_validate_json,
+        temperature=0.0,
+        max_tokens=1000,
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "outline",
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "sections": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "title": {"type": "string"},
+                                    "focus": {"type": "string"},
+                                },
+                                "required": ["title", "focus"],
+                                "additionalProperties": False
+                            }
+                        }
+                    },
+                    "required": ["sections"],
+                    "additionalProperties": False
+                },
+                "strict": True
+            }
+        }
+    )
+    return Outline.model_validate_json(raw).sections[:max_sections]
+
+async def write_section(prompt: str, section: Section, learnings: Sequence[str], system_prompt=''):
+    block = "\n".join(f"<l>{l}</l>" for l in learnings)
+    return reason(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user",
+             "content": f"{SECTION_INSTRUCTIONS}\n{CITATION_NOTE}\n\n## Original Research Question/Topic: {prompt}\n\n##Research learnings: {block}\n\n## Section to write: {section.title} (focus: {section.focus})"},
+        ],
+        stage="section",
+    )
+
+async def write_summary(prompt: str, sections: Sequence[str], system_prompt=''):
+    body = "\n\n".join(sections)
+    return reason(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user",
+             "content": f"{SUMMARY_INSTRUCTIONS}\n{CITATION_NOTE}\n\n## Original Research Question/Topic: {prompt}\n\n## Report sections:\n{body}"},
+        ],
+        stage="summary",
+    )
+
+def sectioned_report(prompt: str, learnings: LearningStore, sources: SourceRegistry, system_prompt='',
+                     top_k: int = REPORT_TOP_K, in_order: bool = True):
+    """
+    Write the report as an outline plus concurrently generated sections.
+
+    Yields ReportParts: the outline, each section, the executive summary
+    written from the finished sections, then the bibliography. With
+    ``in_order`` a section is yielded once it and every section before it
+    are done; otherwise sections are yielded as they finish, for clients
+    that place them by index.
+    """
+    sections = asyncio.run(make_outline(prompt, learnings.top_k(prompt, top_k)))
+    if not sections:
+        report = asyncio.run(final_report(prompt, learnings.top_k(prompt, top_k), sources, system_prompt))
+        yield ReportPart("section", 0, None, report)
+        return
+    yield ReportPart("outline", None, None, "\n".join(s.title for s in sections))
+    headings = [f"{s.title}: {s.focus}" for s in sections]
+    if learnings.ranked:
+        evidence = learnings.top_k_many(headings, SECTION_TOP_K)
+    else:
+        evidence = learnings.top_k_lexical(headings, SECTION_TOP_K)
+
+    usage = getattr(_usage_scope, "totals", None)
+    bypass = getattr(_cache_scope, "bypass", False)
+
+    def write(section, evidence):
+        with track_usage(usage), cache_bypass(bypass):
+            return asyncio.run(write_section(prompt, section, evidence, system_prompt))
+
+    done: dict[int, str] = {}
+    with ThreadPoolExecutor(max_workers=min(REPORT_CONCURRENCY, len(sections))) as pool:
+        futures = {pool.submit(write, sec, ev): i
+                   for i, (sec, ev) in enumerate(zip(sections, evidence))}
+        for fut in (futures if in_order else as_completed(futures)):
+            i = futures[fut]
+            done[i] = fut.result()
+            yield ReportPart("section", i, sections[i].title, sources.linkify(done[i]))
+    body = [done[i] for i in range(len(sections))]
+    summary = asyncio.run(write_summary(prompt, body, system_prompt))
+    yield ReportPart("summary", None, None, sources.linkify(summary))
+    yield ReportPart("sources", None, None, sources.bibliography("\n".join(body + [summary])))
 
 # --------------------------------------------------------------------- #
-# 4️⃣  Recursive research engine
+# 4️⃣  Research engine and batch runner
 # --------------------------------------------------------------------- #
-async def deep_research(prompt: str, *, breadth: int, depth: int,
-                        state: State | None = None,
-                        sem: asyncio.Semaphore | None = None) -> State:
-    state = state or State()
-    sem = sem or asyncio.Semaphore(CONCURRENCY)
+@dataclass(frozen=True)
+class Quota:
+    weight: float = 1.0
+    max_nodes: int = 0          # nodes running at once; 0 = unlimited
+    tokens_per_hour: int = 0    # 0 = unlimited
+
+def tenant_quota(tenant: str) -> Quota:
+    return Quota(**{**TENANT_QUOTAS.get("*", {}), **TENANT_QUOTAS.get(tenant, {})})
 
-    queries = await make_queries(prompt, k=breadth, prior=state.learnings)
+def _check_quotas(quotas) -> None:
+    """Fail at import on a malformed TENANT_QUOTAS, rather than on every request of the tenant it names."""
+    if not isinstance(quotas, dict) or not all(isinstance(q, dict) for q in quotas.values()):
+        raise ValueError("TENANT_QUOTAS must map each tenant to an object of quota fields")
+    for name in quotas:
+        try:
+            quota = tenant_quota(name)
+        except TypeError as exc:   # unknown field, e.g. a misspelt "weight"
+            raise ValueError(f"TENANT_QUOTAS[{name!r}]: {exc}") from None
+        for key, value in asdict(quota).items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"TENANT_QUOTAS[{name!r}]: {key} must be a non-negative number, got {value!r}")
 
-    async def handle(sq: Query):
-        async with sem:
-            docs = await invoke_agent(sq.query)
-        ids, _ = zip(*docs) if docs else ((), ())
-        proc = await distil(sq.query, docs)
+_check_quotas(TENANT_QUOTAS)
 
-        state.learnings.extend(proc.learnings)
-        state.sources.extend(ids)
+@dataclass
+class _Tenant:
+    quota: Quota
+    vtime: float = 0.0   # advances by 1 / weight per node started
+    running: int = 0
+    queues: OrderedDict = field(default_factory=OrderedDict)   # session id -> deque of node callables
+    session_running: dict = field(default_factory=dict)        # session id -> nodes running
+    session_limits: dict = field(default_factory=dict)         # session id -> nodes allowed at once
+    tokens: deque = field(default_factory=deque)               # (time, tokens) within TOKEN_WINDOW
 
-        if depth - 1 > 0 and proc.follow_up_questions:
-            nxt = f"Goal: {sq.research_goal}\n" + "\n".join(proc.follow_up_questions)
-            await deep_research(nxt, breadth=max(1, breadth // 2),
-                                depth=depth - 1, state=state, sem=sem)
+class FairScheduler:
+    """
+    Run research nodes from every session on up to ``threads`` shared
+    threads, started as queued nodes need them.
 
-    await asyncio.gather(*(handle(q) for q in queries))
+    The next node goes to the tenant with the lowest virtual time among
+    those with queued work and room under ``max_nodes``; starting a node
+    advances the tenant's virtual time by ``1 / weight``, so busy tenants
+    share threads in proportion to their weights. A tenant that becomes
+    busy again starts at the current virtual time rather than catching up.
+    Its sessions take turns, each capped at its own node limit. Token use
+    is tracked per tenant over a sliding TOKEN_WINDOW.
+    """
 
-    # dedupe
-    state.learnings = list(dict.fromkeys(state.learnings))
-    state.sources = list(dict.fromkeys(state.sources))
-    return state
+    def __init__(self, threads: int = NODE_THREADS):
+        self._threads = threads
+        self._workers = 0   # threads started so far
+        self._busy = 0      # threads running a node
+        self._cond = threading.Condition()
+        self._tenants: dict[str, _Tenant] = {}
+        self._vtime = 0.0
 
+    def _tenant(self, name: str) -> _Tenant:
+        if name not in self._tenants:
+            self._tenants[name] = _Tenant(tenant_quota(name))
+        return self._tenants[name]
 
-##### --------------------------------------------------------------------- #
-# 5️⃣  FastAPI app
-app = FastAPI()  # Create a FastAPI application instance
+    def submit(self, tenant: str, session_id: str, fn, limit: int | None = None) -> None:
+        """Queue ``fn`` as a node of ``session_id``; at most ``limit`` (default CONCURRENCY) of its nodes run at once."""
+        with self._cond:
+            t = self._tenant(tenant)
+            if not t.running and not any(t.queues.values()):
+                t.vtime = max(t.vtime, self._vtime)
+            t.queues.setdefault(session_id, deque()).append(fn)
+            t.session_limits[session_id] = limit or CONCURRENCY
+            if self._workers < self._threads and self._workers - self._busy < self._runnable():   # no free thread for it
+                threading.Thread(target=self._run, name=f"node-{self._workers}", daemon=True).start()
+                self._workers += 1
+            self._cond.notify()
 
-load_dotenv(override=True)  # Load environment variables from a .env file  
-from fastapi.responses import StreamingResponse
+    def _runnable(self) -> int:
+        """Queued nodes that their session and tenant limits would let start now. Caller holds the lock."""
+        total = 0
+        for t in self._tenants.values():
+            n = sum(min(len(q), t.session_limits[sid] - t.session_running.get(sid, 0)) for sid, q in t.queues.items())
+            total += min(n, max(0, t.quota.max_nodes - t.running)) if t.quota.max_nodes else n
+        return total
+
+    def _next(self):
+        """Pick the next node to start as ``(fn, tenant, session_id)``, or None. Caller holds the lock."""
+        best = None
+        for t in self._tenants.values():
+            if t.quota.max_nodes and t.running >= t.quota.max_nodes:
+                continue
+            if best is not None and t.vtime >= best[0].vtime:
+                continue
+            for sid, nodes in t.queues.items():
+                if nodes and t.session_running.get(sid, 0) < t.session_limits[sid]:
+                    best = (t, sid)
+                    break
+        if best is None:
+            return None
+        t, sid = best
+        fn = t.queues[sid].popleft()
+        t.queues.move_to_end(sid)   # the tenant's other sessions go first next time
+        self._busy += 1
+        t.running += 1
+        t.session_running[sid] = t.session_running.get(sid, 0) + 1
+        self._vtime = t.vtime
+        t.vtime += 1 / max(t.quota.weight, 1e-6)
+        return fn, t, sid
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                picked = self._next()
+                while picked is None:
+                    self._cond.wait()
+                    picked = self._next()
+            fn, t, sid = picked
+            try:
+                fn()
+            except Exception as exc:   # keep the shared thread alive for everyone else's nodes
+                print(f"Research node of session {sid} raised: {exc!r}", flush=True)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    t.running -= 1
+                    t.session_running[sid] -= 1
+                    if not t.session_running[sid] and not t.queues[sid]:   # session idle: forget it
+                        del t.queues[sid], t.session_running[sid], t.session_limits[sid]
+                    self._cond.notify_all()
+
+    def charge(self, tenant: str, tokens: int) -> None:
+        if tokens:
+            with self._cond:
+                self._tenant(tenant).tokens.append((time.time(), tokens))
+
+    def _tokens_used(self, t: _Tenant) -> int:
+        cutoff = time.time() - TOKEN_WINDOW
+        while t.tokens and t.tokens[0][0] < cutoff:
+            t.tokens.popleft()
+        return sum(n for _at, n in t.tokens)
+
+    def exhausted(self, tenant: str) -> bool:
+        """True once the tenant has used its tokens_per_hour within the window."""
+        with self._cond:
+            t = self._tenant(tenant)
+            return bool(t.quota.tokens_per_hour) and self._tokens_used(t) >= t.quota.tokens_per_hour
+
+    def usage(self, tenant: str) -> dict:
+        with self._cond:
+            t = self._tenant(tenant)
+            return {"running": t.running, "queued": sum(len(q) for q in t.queues.values()),
+                    "max_nodes": t.quota.max_nodes, "tokens_last_hour": self._tokens_used(t),
+                    "tokens_per_hour": t.quota.tokens_per_hour, "weight": t.quota.weight}
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            names = list(self._tenants)
+        return {name: self.usage(name) for name in names}
+
+SCHEDULER = FairScheduler()
 
-from pydantic import BaseModel
+def _quota_text(tenant: str, usage: dict) -> str:
+    nodes = f"{usage['running']}/{usage['max_nodes'] or '∞'} nodes running, {usage['queued']} queued"
+    tokens = f"{usage['tokens_last_hour']:,}/{usage['tokens_per_hour'] or '∞'} tokens in the last hour"
+    return f"Tenant {tenant}: {nodes}; {tokens}"
+
+def deep_research(params: ResearchParams, session: ResearchSession | None = None, emit=None) -> ResearchSession:
+    """
+    Research ``params.query`` and write the report; return the finished session.
+
+    Research nodes run on the shared SCHEDULER, at most CONCURRENCY at a
+    time (or on broker workers in distributed mode); the tenant's token
+    quota is checked before starting and before every new node. ``emit(type, text, id=None, title=None)``
+    receives progress, nodes and report parts as they happen; the whole
+    report is also kept on ``session.report``. Once ``session.cancelled``
+    is set, queued nodes are skipped, no new ones are scheduled and no
+    report is written.
+    """
+    session = session or ResearchSession(query=params.query, tenant=params.tenant)
+    emit = emit or (lambda type, text, id=None, title=None: None)
+    if SCHEDULER.exhausted(params.tenant):
+        raise RuntimeError(f"token quota exhausted for tenant {params.tenant!r}")
+    broker = get_broker() if BROKER_URL else None
+    quota_hit = threading.Event()
+    controller = None
+    if params.adaptive:
+        controller = AdaptiveController(params.max_nodes or params.breadth * params.depth * ADAPTIVE_NODES_PER_LEVEL)
+
+    def submit(query: str, depth: int, parent: str | None = None) -> bool:
+        """Schedule a research node unless the same question is already scheduled."""
+        if not session.claim(query):
+            return False
+        task = {"session": session.id, "node": uuid.uuid4().hex[:12], "parent": parent,
+                "level": params.depth - depth + 1, "query": query, "depth": depth,
+                "topic": params.query, "agent_ids": params.agent_ids or [params.agent_id],
+                "hedge": params.hedge, "fast": params.fast_follow_ups, "cache": params.cache,
+                "n_q": controller.max_follow_ups if controller else 3}
+        session.begin()
+        if broker:
+            broker.submit(task)
+        else:
+            SCHEDULER.submit(params.tenant, session.id, lambda: run_node(task))
+        return True
+
+    def run_node(task: dict):
+        if session.cancelled:   # give the thread to other sessions
+            handle_result(_task_result(task, error="cancelled"), accepted=True)
+            return
+        handle_result(run_task(task, on_learnings=accept, on_late_usage=charge_late), accepted=True)
+
+    def schedule(queries: Sequence[str], depth: int, parent: str | None = None):
+        """Submit ``queries``; in adaptive mode only as many as the node budget allows."""
+        if session.cancelled:
+            return
+        if SCHEDULER.exhausted(params.tenant):
+            if not quota_hit.is_set():
+                quota_hit.set()
+                emit("error", f"Token quota for tenant {params.tenant} is used up; reporting on what was gathered.")
+            return
+        granted = controller.reserve(len(queries)) if controller else len(queries)
+        submitted = sum(submit(query, depth, parent) for query in queries[:granted])
+        if controller:
+            controller.release(granted - submitted)
+
+    def accept(result: dict):
+        """Stream a node's learnings; return a callback that schedules its follow-ups one at a time."""
+        result["learnings"], new_sources = session.sources.merge(result["learnings"], result["sources"])
+        emit("node", session.sources.linkify(result["learnings"]), id=result["node"], title=result["query"])
+        facts = split_learnings(result["learnings"])
+        new_facts = session.learnings.extend(facts)  
+        allowance = None   # follow-ups this node may still schedule; None = all of them
+        if controller:
+            result["novelty"] = novelty(len(new_facts), len(facts), new_sources, len(result["sources"]))
+            allowance = controller.follow_ups(result["novelty"])
+
+        def follow_up(question: str):
+            nonlocal allowance
+            if result["depth"] <= 1 or allowance == 0:
+                return
+            if allowance is not None:
+                allowance -= 1
+            schedule([question], result["depth"] - 1, parent=result["node"])
+        return follow_up
+
+    def charge_late(totals: dict):
+        """Charge the tenant for a losing hedged agent run that finished after its node."""
+        SCHEDULER.charge(params.tenant, totals["prompt_tokens"] + totals["completion_tokens"])
+
+    def handle_result(result: dict, accepted: bool = False):
+        """Stream a finished node and schedule its follow-ups unless ``accept`` already did, then record it."""
+        try:
+            if result["error"] == "cancelled":
+                return
+            if result["error"]:
+                emit("error", f"Research failed for: {result['query']} ({result['error']})", id=result["node"])
+                return
+            if not accepted:
+                follow_up = accept(result)
+                for question in result["follow_up_questions"]:
+                    follow_up(question)
+        finally:
+            session.record(NodeRecord.from_result(result))   # first, so wait_idle cannot hang on a later error
+            SCHEDULER.charge(params.tenant, result.get("prompt_tokens", 0) + result.get("completion_tokens", 0))
+            emit("quota", _quota_text(params.tenant, SCHEDULER.usage(params.tenant)), title=params.tenant)
+
+    def wait_for_research():
+        if not broker:
+            session.wait_idle()
+            return
+        try:
+            while session.pending and not session.cancelled:
+                result = broker.results(session.id, timeout=NODE_TIMEOUT)
+                if result is None:
+                    emit("error", "Timed out waiting for research workers; reporting on what was gathered.")
+                    break
+                handle_result(result)
+        finally:
+            broker.close_session(session.id)
+
+    with cache_bypass(not params.cache), track_usage() as usage:
+        # Kick off
+        emit("status", "⚗️ Generating initial research inquiries…")
+        emit("quota", _quota_text(params.tenant, SCHEDULER.usage(params.tenant)), title=params.tenant)
+        # Fan-out each initial node as soon as its query is generated, then wait
+        # until no node is queued or running
+        if broker:
+            broker.open_session(session.id)
+        breadth = params.breadth
+        if params.speculative:
+            schedule([params.query], params.depth)
+            breadth -= 1
+        if breadth > 0:
+            for query_item in stream_queries(params.query, k=breadth, prior=None):
+                schedule([query_item.query], params.depth)
+        wait_for_research()
+
+        # Final report, unless nobody is left to read it
+        if not session.cancelled:
+            emit("phase", f"✅ Research complete. Generating a final report with {ROUTES['report'].deployments[0]}…")
+            if params.report_mode == "sectioned":
+                parts = sectioned_report(params.query, session.learnings, session.sources, params.report_prompt,
+                                         params.report_top_k, in_order=params.stream_format == "text")
+                summary, sections, bibliography = [], {}, []
+                for part in parts:
+                    emit(part.kind, part.text, id=part.index, title=part.title)
+                    if part.kind == "section":
+                        sections[part.index] = part.text
+                    elif part.kind in ("summary", "sources"):
+                        (summary if part.kind == "summary" else bibliography).append(part.text)
+                session.report = "\n\n".join(summary + [sections[i] for i in sorted(sections)] + bibliography)
+            else:
+                relevant = session.learnings.top_k(params.query, params.report_top_k)
+                session.report = asyncio.run(final_report(params.query, relevant, session.sources, params.report_prompt))
+                emit("report", session.report)
+    SCHEDULER.charge(params.tenant, usage["prompt_tokens"] + usage["completion_tokens"])   # queries and report
+    session.finished_at = time.time()
+    return session
+
+def read_topics(path: str, **defaults) -> List[tuple[str, ResearchParams | ValueError]]:
+    """
+    Parse a topics file into ``(id, params)`` pairs.
+
+    Each line is a topic, or a JSON object of ResearchParams fields; blank
+    lines and ``#`` comments are skipped. ``defaults`` fill in fields a line
+    does not set. The id hashes the resulting fields, so the same line with
+    the same defaults always gets the same id. A line that is not valid
+    JSON or not valid ResearchParams gets a ValueError in place of its
+    params, which ``research_batch`` records as a failed topic.
+    """
+    topics = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                fields = {"report_prompt": BATCH_REPORT_PROMPT, **defaults,
+                          **(json.loads(line) if line.startswith("{") else {"query": line})}
+                digest = hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+                topics.append((digest, ResearchParams(**fields)))
+            except (ValueError, TypeError) as exc:   # bad JSON, or fields that fail validation
+                digest = hashlib.sha256(line.encode("utf-8")).hexdigest()[:16]
+                topics.append((digest, ValueError(f"{path}:{n}: invalid topic {line!r}: {exc}")))
+    return topics
+
+def _completed(path: str) -> set[str]:
+    """Ids of the topics that already have a successful result in the JSONL file at ``path``."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:   # a line cut short by an interrupted run
+                continue
+            if row.get("status") == "ok":
+                done.add(row["id"])
+    return done
+
+def research_batch(topics: Sequence[tuple[str, ResearchParams | ValueError]], out: str, workers: int = BATCH_WORKERS) -> dict:
+    """
+    Research ``topics`` on a pool of ``workers`` and export the results.
+
+    Results are appended to a JSONL file as each topic finishes: ``out``
+    itself, or ``out`` with a ``.jsonl`` suffix when ``out`` is a Parquet
+    file, which is written from it at the end. Topics that already have a
+    successful result there are skipped, so an interrupted batch resumes
+    where it stopped; failed topics are retried. Topics that ``read_topics``
+    could not parse are recorded as failed without being researched.
+    """
+    parquet = out.endswith(".parquet")
+    log = os.path.splitext(out)[0] + ".jsonl" if parquet else out
+    done = _completed(log)
+    todo = [(topic_id, params) for topic_id, params in topics if topic_id not in done]
+    counts = {"skipped": len(topics) - len(todo), "ok": 0, "error": 0}
+
+    def research(topic_id: str, params: ResearchParams | ValueError) -> dict:
+        started = time.time()
+        if isinstance(params, ValueError):
+            row = {"id": topic_id, "query": None, "params": None, "status": "error", "error": str(params)}
+            return {**row, "started_at": started, "finished_at": started, "seconds": 0.0}
+        row = {"id": topic_id, "query": params.query, "params": params.model_dump(), "status": "ok", "error": None}
+        try:
+            session = deep_research(params)
+            totals = session.tree()["totals"]
+            row.update(report=session.report, learnings=list(session.learnings), sources=session.sources.entries(),
+                       nodes=totals["nodes"], failed_nodes=totals["failed"], prompt_tokens=totals["prompt_tokens"],
+                       cached_tokens=totals["cached_tokens"], completion_tokens=totals["completion_tokens"])
+        except Exception as exc:
+            row.update(status="error", error=repr(exc))
+        row.update(started_at=started, finished_at=time.time(), seconds=round(time.time() - started, 3))
+        return row
+
+    os.makedirs(os.path.dirname(os.path.abspath(log)), exist_ok=True)
+    with open(log, "a+", encoding="utf-8") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell():   # start on a fresh line if the last run was cut off mid-line
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(research, topic_id, params) for topic_id, params in todo]
+            for n, fut in enumerate(as_completed(futures), start=1):
+                row = fut.result()
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                f.flush()
+                counts[row["status"]] += 1
+                print(f"[{n}/{len(todo)}] {row['status']} in {row['seconds']:.0f}s: {row['query'] or row['error'].splitlines()[0]}", flush=True)
+
+    if parquet:
+        import pandas as pd
+
+        rows = {}
+        with open(log, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                rows[row["id"]] = row   # the latest attempt per topic
+        pd.DataFrame(list(rows.values())).to_parquet(out, index=False)
+    return counts
+
+
+# --------------------------------------------------------------------- #
+# 5️⃣  Distributed research workers
+# --------------------------------------------------------------------- #
+# A task is one research node: {"session", "node", "parent", "level",
+# "query", "depth", "topic", "agent_ids", "hedge", "fast", "n_q"}. Workers answer with the
+# same dict plus "learnings" (citing "sources" as task-local [n] ids),
+# "agent", "citations", "follow_up_questions", timings,
+# token counts and "error"; the deep_research() call that owns the session
+# decides which follow-ups become new tasks.
+TASKS_KEY = "deep_research:tasks"
+RESULTS_KEY = "deep_research:results:{session}"
+RESULTS_TTL = 3600  # seconds a session's result list survives without being read
+
+def _task_result(task: dict, error: str | None = None) -> dict:
+    """A result for ``task`` with nothing researched yet and no tokens used."""
+    now = time.time()
+    return {**task, "learnings": None, "sources": [], "citations": [], "follow_up_questions": [], "error": error,
+            "started_at": now, "finished_at": now, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+def run_task(task: dict, on_learnings=None, on_late_usage=None) -> dict:
+    """
+    Research one node: agent call plus follow-up question generation.
+
+    In-process callers may pass ``on_learnings(result)``; it is called as
+    soon as the agent has answered and may return a callback that receives
+    each follow-up question the moment it has been generated. If follow-up
+    generation fails, the error is logged and the node keeps its learnings
+    with the follow-ups it has so far. Tokens of
+    hedged agent runs that finish after the node are passed to
+    ``on_late_usage(totals)``; without it they only reach TELEMETRY.
+    """
+    result = _task_result(task)
+    with track_usage() as usage, cache_bypass(not task.get("cache", True)):
+        try:
+            # sources carry task-local ids; the session merges them into its own registry
+            docs, sources, result["agent"] = invoke_agents(task["query"], task["topic"], task["agent_ids"],
+                                                           task.get("hedge", True), on_late_usage)
+            result["learnings"] = docs
+            result["sources"] = sources.entries()
+            result["citations"] = [e["url"] for e in result["sources"]]
+            follow_up = on_learnings(result) if on_learnings else None
+        except Exception as exc:
+            result["error"] = repr(exc)
+        else:
+            try:
+                for question in stream_follow_ups(task["query"], docs, n_q=task.get("n_q", 3), fast=task.get("fast", False)):
+                    result["follow_up_questions"].append(question)
+                    if follow_up:
+                        follow_up(question)
+            except Exception as exc:   # the learnings stand; the branch just ends here
+                print(f"Follow-up questions failed for {task['query']!r}: {exc!r}", flush=True)
+    result.update(usage, finished_at=time.time())
+    return result
+
+def serve_tasks(next_task, publish, concurrency: int = WORKER_CONCURRENCY) -> None:
+    """Run ``concurrency`` threads that take tasks from ``next_task`` and publish results forever."""
+    def loop():
+        while True:
+            task = next_task()
+            if task is not None:
+                publish(run_task(task))
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def _local_worker_main(tasks, results, concurrency: int) -> None:
+    if WARM_UP:
+        warm_up()
+    serve_tasks(tasks.get, results.put, concurrency)
+
+class LocalBroker:
+    """
+    Stand-in for Redis on a single machine: a multiprocessing task queue
+    consumed by ``workers`` spawned processes. One router thread hands
+    results to the session queue that is waiting for them.
+    """
+
+    def __init__(self, workers: int = LOCAL_WORKERS, concurrency: int = WORKER_CONCURRENCY):
+        ctx = multiprocessing.get_context("spawn")
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._sessions: dict[str, queue.Queue] = {}
+        self._lock = threading.Lock()
+        self._procs = [ctx.Process(target=_local_worker_main, args=(self._tasks, self._results, concurrency), daemon=True)
+                       for _ in range(workers)]
+        for p in self._procs:
+            p.start()
+        threading.Thread(target=self._route, daemon=True).start()
+
+    def _route(self) -> None:
+        while True:
+            result = self._results.get()
+            with self._lock:
+                inbox = self._sessions.get(result["session"])
+            if inbox is not None:   # results for closed sessions are dropped
+                inbox.put(result)
+
+    def open_session(self, session: str) -> None:
+        with self._lock:
+            self._sessions[session] = queue.Queue()
+
+    def submit(self, task: dict) -> None:
+        self._tasks.put(task)
+
+    def results(self, session: str, timeout: float) -> dict | None:
+        try:
+            return self._sessions[session].get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close_session(self, session: str) -> None:
+        with self._lock:
+            self._sessions.pop(session, None)
+
+class RedisBroker:
+    """Tasks and per-session results as Redis lists, shared by any number of API and worker hosts."""
+
+    def __init__(self, url: str):
+        import redis   # optional dependency, only needed for redis:// brokers
+        self._redis = redis.Redis.from_url(url)
+
+    def open_session(self, session: str) -> None:
+        pass
+
+    def submit(self, task: dict) -> None:
+        self._redis.rpush(TASKS_KEY, json.dumps(task))
+
+    def next_task(self, timeout: int = 5) -> dict | None:
+        item = self._redis.blpop([TASKS_KEY], timeout=timeout)
+        return json.loads(item[1]) if item else None
+
+    def publish(self, result: dict) -> None:
+        key = RESULTS_KEY.format(session=result["session"])
+        self._redis.pipeline().rpush(key, json.dumps(result)).expire(key, RESULTS_TTL).execute()
+
+    def results(self, session: str, timeout: float) -> dict | None:
+        item = self._redis.blpop([RESULTS_KEY.format(session=session)], timeout=max(1, int(timeout)))
+        return json.loads(item[1]) if item else None
+
+    def close_session(self, session: str) -> None:
+        self._redis.delete(RESULTS_KEY.format(session=session))
+
+@lru_cache(maxsize=None)
+def get_broker() -> LocalBroker | RedisBroker:
+    """Broker for RESEARCH_BROKER_URL, created on first use."""
+    if BROKER_URL == "local":
+        return LocalBroker()
+    if BROKER_URL.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(BROKER_URL)
+    raise ValueError(f"Unsupported RESEARCH_BROKER_URL: {BROKER_URL!r}")
+
+def run_worker(concurrency: int = WORKER_CONCURRENCY) -> None:
+    """Consume research tasks from the Redis broker until interrupted."""
+    broker = get_broker()
+    if not isinstance(broker, RedisBroker):
+        raise SystemExit("`worker` needs a redis:// RESEARCH_BROKER_URL; the local broker starts its own workers.")
+    if WARM_UP:
+        print(f"Warm-up: {warm_up()}", flush=True)
+    print(f"Research worker consuming {TASKS_KEY} with {concurrency} threads", flush=True)
+    serve_tasks(broker.next_task, broker.publish, concurrency)
+
+
+# --------------------------------------------------------------------- #
+# 6️⃣  FastAPI app
+WARM_UP_STEPS: dict = {}  # filled in by the startup warm-up, see GET /warmup
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up in a background thread so the server accepts requests right away."""
+    if WARM_UP:
+        threading.Thread(target=lambda: WARM_UP_STEPS.update(warm_up()), name="warm-up", daemon=True).start()
+    yield
+
+app = FastAPI(lifespan=lifespan)  # Create a FastAPI application instance
+
+from fastapi.responses import StreamingResponse
 
 class ResearchParams(BaseModel):
     query:    str
@@ -269,99 +2231,143 @@ class ResearchParams(BaseModel):
     depth:    int = 4
     report_prompt: str
     agent_id: str = Field(default=os.getenv("AGENT_ID", ""))
+    agent_ids: List[str] = Field(default_factory=lambda: list(AGENT_POOL))  # agent pool (e.g. web + Wikipedia); defaults to AGENT_POOL, else agent_id
+    hedge: bool = True  # start a backup agent run when the first one is slower than usual
+    report_top_k: int = REPORT_TOP_K  # most relevant learnings passed to the report writer (all of them without embeddings)
+    report_mode: Literal["single", "sectioned"] = "single"  # "sectioned" writes outline sections in parallel
+    fast_follow_ups: bool = False  # generate follow-up questions on the "distil_fast" route
+    stream_format: Literal["text", "events"] = "text"  # "events" streams one JSON object per line
+    adaptive: bool = False  # expand, narrow or stop branches by novelty instead of a fixed fan-out
+    max_nodes: int | None = None  # adaptive node budget; default breadth * depth * ADAPTIVE_NODES_PER_LEVEL
+    cache: bool = True  # reuse memoised LLM responses; false forces fresh completions
+    speculative: bool = False  # research the raw query as one of the initial nodes while the others are generated
+    tenant: str = "default"  # team or caller; quotas and fair scheduling apply per tenant (see TENANT_QUOTAS)
+
+    @field_validator("adaptive")
+    @classmethod
+    def _adaptive_needs_embeddings(cls, adaptive: bool) -> bool:
+        # Novelty counts near-duplicate facts; with exact-match dedup every node would score as new
+        if adaptive and not EMBEDDING_MODEL:
+            raise ValueError("adaptive mode needs an embeddings deployment; set AOAI_EMBEDDING_MODEL")
+        return adaptive
+
+
+CONCURRENCY = 5  # max nodes of one session running at once  
+
+
+@app.get("/telemetry")
+async def telemetry():
+    """Token usage per pipeline stage, including prompt-cache hits."""
+    return TELEMETRY.snapshot()
+
+@app.get("/agents")
+async def agents():
+    """Per-agent runs, failures, hedges and latency percentiles seen by this process."""
+    return AGENT_STATS.snapshot()
+
+@app.get("/cache")
+async def response_cache():
+    """Response cache hits, misses, evictions and size."""
+    return RESPONSE_CACHE.snapshot() if RESPONSE_CACHE else {"enabled": False}
 
+@app.get("/agents/threads")
+async def agent_threads():
+    """Agent threads created, in use, deleted and still stored in the project by this process."""
+    return THREAD_JANITOR.snapshot()
+
+@app.get("/tenants")
+async def tenants():
+    """Per-tenant running and queued nodes, token use in the last hour, and quotas."""
+    return SCHEDULER.snapshot()
+
+@app.get("/warmup")
+async def warmup():
+    """Seconds (or error) per startup warm-up step; empty while it is still running."""
+    return WARM_UP_STEPS
+
+@app.get("/sessions/{session_id}/tree")
+async def research_tree(session_id: str):
+    """Research tree of a running or recent session (id from the X-Session-Id header)."""
+    session = SESSIONS.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown research session")
+    return session.tree()
 
-CONCURRENCY = 5  # max parallel worker threads  
-import threading  # Import threading for creating and managing threads  
-import queue  # Import queue for creating a queue to handle data between threads  
-import tempfile  # Import tempfile for creating temporary files and directories  
 @app.post("/run_deep_research_stream")  
 async def run_deep_research_stream(params: ResearchParams):  
     """  
     Streams deep research in the same style as your `run_agent` example:  
-    - spawn a single “driver” thread  
-    - communicate via queue.Queue  
-    - return a generator that yields queue items until a sentinel  
+    - spawn a single “driver” thread running ``deep_research``  
+    - communicate via a bounded EventBuffer (backpressure for slow clients,
+      cancelling the session once the client disconnects or stalls)  
+    - return a generator that yields buffered chunks until the driver finishes  
+
+    The research is recorded in a ResearchSession whose id is returned in
+    the X-Session-Id header.
     """  
+    if SCHEDULER.exhausted(params.tenant):
+        raise HTTPException(status_code=429, detail=f"Token quota exhausted for tenant {params.tenant!r}")
+    session = ResearchSession(query=params.query, tenant=params.tenant)
+    SESSIONS.add(session)
+
     def generate_response():  
-        q: queue.Queue[str] = queue.Queue()  
-        state = State()  
-        threads: list[threading.Thread] = []  
-        sem = threading.Semaphore(CONCURRENCY)  
-        researched_topics = set()
-  
-        def worker(sq: Query, depth: int):  
-            with sem:  
-                # 1️⃣ announce the goal  
-                if sq.query not in researched_topics:
-                    researched_topics.add(sq.query)  
-                    #q.put(f"🔍 Researching: {sq.query}<br/>")
-                    # q.put(f"<span style='color:dodgerblue;'><b>Research Topic: </b></span>{sq.query}<br/>")  
-  
-                # 2️⃣ do the search  
-                docs = asyncio.run(invoke_agent(sq.query, params.query, params.agent_id)) 
-                # print(docs, flush=True) 
-                # q.put(f"  • Retrieved {len(docs)} Reviews\n")  
-  
-                # 3️⃣ distill learnings  
-                proc = asyncio.run(distil(sq.query, docs))  
-                q.put(f"<span style='color:dodgerblue;'><b>Research Topic: </b></span>{sq.query}<br/>") 
-                q.put("<span style='color:limegreen;'><b>Learnings:</b></span><br/>")  
-                # for learning in proc.learnings:  
-                q.put(f"&emsp; • {docs}<br/>")
-                q.put("<br/>")  
-  
-                # 4️⃣ record in state  
-                state.learnings.append(docs)  
-                # state.sources.extend(doc_id for doc_id, _ in docs)  
-  
-                # 5️⃣ spawn follow-ups  
-                if depth > 1 and proc.follow_up_questions:  
-                    for fu in proc.follow_up_questions:  
-                        child = Query(query=fu)  
-                        t = threading.Thread(target=worker, args=(child, depth - 1))  
-                        t.start()  
-                        threads.append(t)  
-  
+        events = EventBuffer()
+
+        def emit(type: str, text: str, id=None, title=None):
+            chunk = Event(type, text, id, title).render(params.stream_format)
+            if chunk:
+                events.put(type, chunk)
+            if events.closed:   # client disconnected or stalled
+                session.cancelled = True
         def run_research():  
-            # Kick off  
-            
-            q.put("⚗️ Generating initial research inquiries…<br/><br/>")  
-            queries = asyncio.run(make_queries(params.query, k=params.breadth, prior=None))  
-  
-            # Fan-out initial workers  
-            for query_item in queries:  
-                t = threading.Thread(target=worker, args=(query_item, params.depth))  
-                t.start()  
-                threads.append(t)  
-  
-            # Wait for all workers  
-            for t in threads:  
-                t.join()  
-  
-            # Final report  
-            q.put("<h2>✅ Research complete. Generating a final report with o4-mini…</h2><br/><br/>")  
-     
-            report = asyncio.run(final_report(params.query, state.learnings, state.sources, params.report_prompt))  
-            q.put(report + "\n")  
-  
-            # Sentinel  
-            q.put("<<DONE>>")  
+            try:
+                deep_research(params, session, emit)
+            finally:
+                events.finish()
   
         # Start the driver thread  
         driver = threading.Thread(target=run_research, daemon=True)  
         driver.start()  
   
-        # Synchronous generator that yields until we see "<<DONE>>"  
-        while True:  
-            chunk = q.get()  
-            if chunk == "<<DONE>>":  
-                break  
-            if chunk is None:  
-                continue  
-            yield chunk  
+        # Synchronous generator that yields until the driver finishes  
+        yield from events
   
         # Clean up  
         driver.join()  
   
-    return StreamingResponse(generate_response(), media_type="text/plain") 
\ No newline at end of file
+    media_type = "application/x-ndjson" if params.stream_format == "events" else "text/plain"
+    return StreamingResponse(generate_response(), media_type=media_type, headers={"X-Session-Id": session.id}) 
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Deep Research API")
+    parser.set_defaults(command="serve", host="127.0.0.1", port=8000)
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="run the API server (default)")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    worker = commands.add_parser("worker", help="consume research tasks from a redis:// RESEARCH_BROKER_URL")
+    worker.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY)
+    batch = commands.add_parser("batch", help="research every topic in a file and write the results")
+    batch.add_argument("topics", help="one topic, or one JSON object of request fields, per line")
+    batch.add_argument("--out", required=True, help="results file: .jsonl, or .parquet (needs pyarrow)")
+    batch.add_argument("--workers", type=int, default=BATCH_WORKERS, help="topics researched at the same time")
+    batch.add_argument("--breadth", type=int, default=3)
+    batch.add_argument("--depth", type=int, default=2)
+    batch.add_argument("--report-mode", choices=["single", "sectioned"], default="single")
+    batch.add_argument("--report-prompt", default=BATCH_REPORT_PROMPT)
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        run_worker(args.concurrency)
+    elif args.command == "batch":
+        topics = read_topics(args.topics, breadth=args.breadth, depth=args.depth, report_mode=args.report_mode,
+                             report_prompt=args.report_prompt)
+        counts = research_batch(topics, args.out, args.workers)
+        print(f"{counts['ok']} researched, {counts['error']} failed, {counts['skipped']} already done")
+        raise SystemExit(1 if counts["error"] else 0)
+    else:
+        import uvicorn
+        uvicorn.run(app, host=args.host, port=args.port)
@@ -1,24 +1,101 @@
 import streamlit as st
 from datetime import datetime
+import json
 import requests
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
 
 
-# Dummy chat function
-# This function will be called when the user submits a chat prompt
-# Replace this with your actual chat handler as needed
+FRAME_BUDGET = 0.1       # seconds; growing elements are redrawn at most this often
+STREAM_CHUNK_SIZE = 8192  # bytes per read from the API stream
+
+
+class StreamRenderer:
+    """
+    Render NDJSON research events (stream_format="events") incrementally.
+
+    Each research node and report section gets its own element, written
+    once when it arrives, so long runs never re-render earlier output. Only
+    the status line is redrawn, at most once per FRAME_BUDGET; an update
+    inside the budget is drawn with the next event, and phase changes at once.
+    """
+
+    def __init__(self):
+        self.status = st.empty()
+        self.quota = st.empty()
+        self.progress = st.expander("Research progress", expanded=True)
+        self.report = st.container()
+        self.summary = self.report.empty()
+        self.sections = {}
+        self.sources = None
+        self.texts = {}              # report pieces, for the chat transcript
+        self.nodes = 0
+        self._status_text = None     # status line waiting to be drawn
+        self._drawn_at = 0.0
+
+    def handle(self, event):
+        kind, text = event["type"], event["text"].replace("```", "")
+        if kind in ("status", "phase"):
+            self._set_status(text, force=kind == "phase")
+        elif kind == "node":
+            self.nodes += 1
+            self.progress.markdown(f"**🔍 {event['title']}**\n\n{text}", unsafe_allow_html=True)
+            self._set_status(f"Researched {self.nodes} topics…")
+        elif kind == "error":
+            self.progress.warning(text)
+        elif kind == "quota":
+            self.quota.caption(text)
+        elif kind == "outline":
+            # Reserve one slot per section so sections finishing out of order land in place
+            for index, _title in enumerate(text.splitlines()):
+                self.sections[index] = self.report.empty()
+            self.sources = self.report.empty()
+        elif kind in ("section", "report"):
+            index = event["id"] or 0
+            self.sections.setdefault(index, self.report.empty()).markdown(text, unsafe_allow_html=True)
+            self.texts[("section", index)] = text
+        elif kind == "summary":
+            self.summary.markdown(text, unsafe_allow_html=True)
+            self.texts[("summary", 0)] = text
+        elif kind == "sources":
+            (self.sources or self.report.empty()).markdown(text)
+            self.texts[("sources", 0)] = text
+        self._draw_status()
+
+    def _set_status(self, text, force=False):
+        self._status_text = text
+        self._draw_status(force)
+
+    def _draw_status(self, force=False):
+        if self._status_text is None:
+            return
+        now = time.monotonic()
+        if force or now - self._drawn_at >= FRAME_BUDGET:
+            self.status.markdown(self._status_text)
+            self._status_text = None
+            self._drawn_at = now
+
+    def finish(self):
+        self._set_status("✅ Done", force=True)
+
+    def transcript(self):
+        """The report as one markdown string: summary, sections in order, sources."""
+        order = {"summary": 0, "section": 1, "sources": 2}
+        return "\n\n".join(self.texts[key] for key in sorted(self.texts, key=lambda k: (order[k[0]], k[1])))
 
 
 now = datetime.now()
 now_str = now.strftime("%Y-%m-%d")
 
 
+# The date sits at the end so the rest of the prompt is a stable prefix
+# that Azure OpenAI can serve from its prompt cache.
 default_report_prompt = (
         f"""# Research Analyst Brief  
-You are an expert research analyst. Today is {now_str}.
+You are an expert research analyst.
 
 Your task is to generate a detailed Markdown report (7–10 pages) on a designated research topic, based strictly on the cited research provided.  This should be a written report in the style of an academic research paper or investigative news article.
 All insights and analysis MUST be grounded in the information provided.
@@ -45,7 +122,7 @@ This report is intended for an informed but non-specialist audience, including e
   - Include key data points, explanations, or summaries.
   - Present information using written paragraphs with inline source citations.
   - Include subsections and tableswhere appropriate.
-  - Citations should be in the same format as the initial research findings provided and included inline. Assume these will be viewed on a display screen, so use clickable links.
+  - Citations should use the same numeric markers as the research findings (e.g. [3]) and be included inline. They are converted to clickable links.
 
 ### 3. Comprehensive Topic Overview
 - Provide a broader contextual analysis of the subject.
@@ -59,7 +136,7 @@ This report is intended for an informed but non-specialist audience, including e
   - Headings and subheadings
   - Detailed written paragraphs for narrative explanations. Prioritize news-report style paragraphs over bullet points for in-depth analysis.
   - Tables with clearly labeled rows/columns
-  - Inline links (if web-based)
+  - Inline source markers (e.g. [3])
 
 ### 5. Analytical Depth
 - Draw conclusions supported directly by the data or source material.
@@ -74,11 +151,13 @@ This report is intended for an informed but non-specialist audience, including e
 ### 7. Sourcing
 - Base your analysis solely on the research findings provided to you.
 - It is critical that you include primary source citations in your report from the provided research.
-- **IMPORTANT**: Assume that this report will be viewed on a display screen and use clickable links for citations.
+- **IMPORTANT**: Cite sources with the numeric markers from the research findings (e.g. [3]). They are rendered as clickable links and a list of sources is appended automatically, so do not write your own.
 ---
 
 ## Purpose:
-Deliver a well-structured, evidence-based report that deepens understanding of the topic, informs future inquiry, and supports decision-making, education, or strategic planning depending on the context."""
+Deliver a well-structured, evidence-based report that deepens understanding of the topic, informs future inquiry, and supports decision-making, education, or strategic planning depending on the context.
+
+Today is {now_str}."""
     )
 
 if "research_agent_prompt" not in st.session_state:
@@ -111,6 +190,17 @@ with st.expander("Deep Research Settings"):
         help="Set how wide the research scope should be"
     )
 
+    report_mode = st.radio(
+        label="Report Mode",
+        options=["single", "sectioned"],
+        horizontal=True,
+        help="'sectioned' writes report sections in parallel and shows each one as soon as it is ready"
+    )
+    speculative = st.checkbox(
+        label="Speculative Start",
+        help="Start researching the topic itself while the initial research questions are being generated"
+    )
+
     # Text areas side by side
     report_agent_prompt = st.text_area(
         label="Report Agent Prompt",
@@ -126,7 +216,7 @@ if prompt:
     st.chat_message("user").write(prompt)
     # Call the dummy chat function and display its response
     with st.chat_message("assistant"):
-        placeholder2 = st.markdown(body="")
+        renderer = StreamRenderer()
         partial_response = ""
 
 
@@ -136,6 +226,10 @@ if prompt:
             "depth": depth,
             "breadth": breadth,
             "agent_id": os.environ.get("AGENT_ID", "default_agent_id"),
+            "report_mode": report_mode,
+            "speculative": speculative,
+            "tenant": os.environ.get("RESEARCH_TENANT", "default"),
+            "stream_format": "events",
         }
         
 
@@ -143,20 +237,17 @@ if prompt:
             uri = '127.0.0.1:8000' # Updaate this to your API endpoint
             response = requests.post(f'http://{uri}/run_deep_research_stream', json=(payload), stream=True)
             if response.status_code == 200:
-                for chunk in response.iter_content( decode_unicode=True):
-                    if chunk:
-                       
-                        partial_response += chunk.replace("```","")
-                        placeholder2.markdown(partial_response, unsafe_allow_html=True)
-                        
+                for line in response.iter_lines(chunk_size=STREAM_CHUNK_SIZE, decode_unicode=True):
+                    if line:
+                        renderer.handle(json.loads(line))
+                renderer.finish()
+                partial_response = renderer.transcript()
             else:
                 partial_response = f"Error from API: {response.status_code} - {response.text}"
-                placeholder2.markdown(partial_response)
+                st.markdown(partial_response)
         except Exception as e:
             partial_response = f"Request failed: {e}"
-            placeholder2.markdown(partial_response)
-
-        placeholder2.markdown(partial_response, unsafe_allow_html=True)
+            st.markdown(partial_response)
         
 
     st.session_state["messages"].append({"role": "assistant", "content": partial_response})
\ No newline at end of file
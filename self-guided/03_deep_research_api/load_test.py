@@ -0,0 +1,343 @@
+"""
+Load test for deep_research_api against a mock LLM and agent backend.
+
+`run` starts the API in a child process with Azure OpenAI and the research
+agents replaced by mocks that sleep for a configurable latency. It then
+ramps through increasing numbers of concurrent research sessions. For each
+level it records time to first byte, completion time and errors per
+session, and it samples the server's RSS and thread count. A probe also
+times a light endpoint while the sessions run, which shows when the
+server stops responding. Results are printed and saved as JSON;
+`compare` lines up two or more result files, e.g. from two engine versions.
+
+    python load_test.py run --levels 1,10,50,100 --out new.json
+    git show HEAD~3:./deep_research_api.py > /tmp/old_engine.py
+    python load_test.py run --engine /tmp/old_engine.py --label old --out old.json
+    python load_test.py compare old.json new.json
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_INTERVAL = 0.25   # seconds between RSS/thread samples and probe requests
+PROBE_PATH = "/telemetry"
+
+
+# --------------------------------------------------------------------- #
+# Mock backend (runs inside the server process)
+# --------------------------------------------------------------------- #
+
+def _sleep(mean: float) -> None:
+    """Sleep for a log-normally jittered ``mean`` seconds, like a remote call."""
+    if mean > 0:
+        time.sleep(random.lognormvariate(0, 0.35) * mean)
+
+def _mock_json(schema: str, content: str) -> str:
+    """A structured answer for the response schema the engine asked for."""
+    tag = hashlib.sha1(content.encode()).hexdigest()[:6]   # unique follow-ups so nodes are not deduplicated
+    if schema == "queries":
+        return json.dumps({"queries": [{"query": f"Mock question {tag}-{i}"} for i in range(5)]})
+    if schema == "processing":
+        return json.dumps({"follow_up_questions": [f"Mock follow-up {tag}-{i}" for i in range(5)]})
+    if schema == "outline":
+        return json.dumps({"sections": [{"title": f"Section {i}", "focus": "mock focus"} for i in range(1, 4)]})
+    return json.dumps({})
+
+def install_mocks(engine, llm_seconds: float, agent_seconds: float) -> None:
+    """Replace the engine's LLM, embedding and agent calls with local mocks."""
+    def chat(messages, *args, **kw):
+        _sleep(llm_seconds)
+        fmt = kw.get("response_format") or {}
+        if fmt.get("type") == "json_schema":
+            return _mock_json(fmt["json_schema"]["name"], messages[-1]["content"])
+        return "## Mock section\n\n" + "Mock finding with a citation [1]. " * 40
+
+    async def invoke_agent(question, original_topic, agent_id, sources=None):
+        _sleep(agent_seconds)
+        urls = [f"https://example.com/{hashlib.sha1((question + str(i)).encode()).hexdigest()[:8]}" for i in range(3)]
+        if sources is not None:
+            cites = [f"[{sources.register(url, 'Mock source')}]" for url in urls]
+        else:
+            cites = [f"[source]({url})" for url in urls]
+        return "\n".join(f"- Mock learning about {question} {cite}" for cite in cites)
+
+    def chat_stream(messages, *args, **kw):
+        text = chat(messages, **kw)
+        for i in range(0, len(text), 16):
+            yield text[i:i + 16]
+
+    engine.chat = chat
+    engine.reason = chat
+    engine.chat_stream = chat_stream
+    engine.invoke_agent = invoke_agent
+    if hasattr(engine, "embed"):
+        import numpy as np
+
+        def embed(texts):
+            vectors = np.stack([np.random.default_rng(int(hashlib.sha1(t.encode()).hexdigest()[:8], 16)).standard_normal(256)
+                                for t in texts]).astype(np.float32) if texts else np.zeros((0, 256), np.float32)
+            return vectors / np.linalg.norm(vectors, axis=1, keepdims=True).clip(1e-12)
+        engine.embed = embed
+
+def load_engine(path: str):
+    """Import the engine module from ``path`` (any version of deep_research_api.py)."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    spec = importlib.util.spec_from_file_location("deep_research_api", path)
+    engine = importlib.util.module_from_spec(spec)
+    sys.modules["deep_research_api"] = engine   # so worker processes and pickling resolve the same module
+    spec.loader.exec_module(engine)
+    return engine
+
+def serve(args) -> int:
+    import uvicorn
+
+    os.environ.setdefault("AGENT_ID", "mock-agent")
+    engine = load_engine(args.engine)
+    install_mocks(engine, args.llm_seconds, args.agent_seconds)
+    uvicorn.run(engine.app, host="127.0.0.1", port=args.port, log_level="warning")
+    return 0
+
+
+# --------------------------------------------------------------------- #
+# Load generator
+# --------------------------------------------------------------------- #
+
+def process_stats(pid: int) -> tuple[float, int]:
+    """(RSS in MB, thread count) of process ``pid``."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["Threads"])
+    except FileNotFoundError:   # not Linux
+        import psutil
+
+        proc = psutil.Process(pid)
+        return proc.memory_info().rss / 2**20, proc.num_threads()
+
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def one_session(url: str, payload: dict, timeout: float) -> dict:
+    """Run one research session and time its first byte and completion."""
+    started = time.monotonic()
+    ttfb = None
+    size = 0
+    try:
+        with requests.post(url, json=payload, stream=True, timeout=timeout) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(chunk_size=None):
+                if ttfb is None:
+                    ttfb = time.monotonic() - started
+                size += len(chunk)
+    except Exception as exc:
+        return {"ok": False, "error": repr(exc), "seconds": time.monotonic() - started}
+    return {"ok": True, "ttfb": ttfb, "seconds": time.monotonic() - started, "bytes": size}
+
+def run_level(base: str, pid: int, sessions: int, payload: dict, timeout: float) -> dict:
+    """Start ``sessions`` concurrent sessions and summarise what happened."""
+    stop = threading.Event()
+    samples: list[tuple[float, int]] = []
+    probes: list[float] = []
+
+    def sample():
+        while not stop.is_set():
+            samples.append(process_stats(pid))
+            started = time.monotonic()
+            try:
+                requests.get(base + PROBE_PATH, timeout=timeout)
+                probes.append(time.monotonic() - started)
+            except requests.RequestException:
+                probes.append(timeout)
+            stop.wait(SAMPLE_INTERVAL)
+
+    rss_start, threads_start = process_stats(pid)
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        results = list(pool.map(lambda _: one_session(base + "/run_deep_research_stream", payload, timeout),
+                                range(sessions)))
+    wall = time.monotonic() - started
+    stop.set()
+    sampler.join()
+    rss_end, threads_end = process_stats(pid)
+
+    ok = [r for r in results if r["ok"]]
+    ttfbs = [r["ttfb"] for r in ok if r["ttfb"] is not None]
+    seconds = [r["seconds"] for r in ok]
+    return {
+        "sessions": sessions,
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "first_error": next((r["error"] for r in results if not r["ok"]), None),
+        "wall_seconds": wall,
+        "ttfb_p50": percentile(ttfbs, 0.5),
+        "ttfb_p95": percentile(ttfbs, 0.95),
+        "completion_p50": percentile(seconds, 0.5),
+        "completion_p95": percentile(seconds, 0.95),
+        "completion_max": max(seconds, default=None),
+        "probe_p95": percentile(probes, 0.95),
+        "rss_start_mb": rss_start,
+        "rss_peak_mb": max([s[0] for s in samples] + [rss_end]),
+        "rss_end_mb": rss_end,
+        "threads_start": threads_start,
+        "threads_peak": max([s[1] for s in samples] + [threads_end]),
+        "threads_end": threads_end,
+    }
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_ready(base: str, server: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with code {server.returncode}")
+        try:
+            requests.get(base + "/openapi.json", timeout=1).raise_for_status()
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+def engine_label(path: str) -> str:
+    """Short git revision of the engine file, or its name outside a checkout."""
+    try:
+        rev = subprocess.run(["git", "log", "-1", "--format=%h", "--", os.path.basename(path)],
+                             cwd=os.path.dirname(os.path.abspath(path)), capture_output=True, text=True).stdout.strip()
+    except OSError:
+        rev = ""
+    return rev or os.path.basename(path)
+
+METRICS = [  # (key, column header, format)
+    ("ok", "ok", "{:.0f}"),
+    ("errors", "err", "{:.0f}"),
+    ("ttfb_p50", "ttfb p50 s", "{:.2f}"),
+    ("ttfb_p95", "ttfb p95 s", "{:.2f}"),
+    ("completion_p50", "done p50 s", "{:.1f}"),
+    ("completion_p95", "done p95 s", "{:.1f}"),
+    ("probe_p95", "probe p95 s", "{:.3f}"),
+    ("rss_peak_mb", "rss peak MB", "{:.0f}"),
+    ("rss_end_mb", "rss end MB", "{:.0f}"),
+    ("threads_peak", "thr peak", "{:.0f}"),
+    ("threads_end", "thr end", "{:.0f}"),
+]
+
+def fmt(value, spec: str) -> str:
+    return "-" if value is None else spec.format(value)
+
+def print_levels(levels: list[dict]) -> None:
+    print(f"{'sessions':>8}  " + "  ".join(f"{header:>11}" for _key, header, _spec in METRICS))
+    for level in levels:
+        print(f"{level['sessions']:>8}  " + "  ".join(f"{fmt(level[key], spec):>11}" for key, _header, spec in METRICS))
+
+def run(args) -> int:
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    log = tempfile.NamedTemporaryFile("w", prefix="load_test_server_", suffix=".log", delete=False)
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", "--engine", args.engine, "--port", str(port),
+         "--llm-seconds", str(args.llm_seconds), "--agent-seconds", str(args.agent_seconds)],
+        cwd=HERE, stdout=subprocess.DEVNULL, stderr=log,
+    )
+    payload = {"query": "Mock research topic", "breadth": args.breadth, "depth": args.depth,
+               "report_prompt": "Write a short report.", "report_mode": args.report_mode}
+    result = {"label": args.label or engine_label(args.engine), "engine": os.path.abspath(args.engine),
+              "created_at": time.time(), "payload": payload,
+              "backend": {"llm_seconds": args.llm_seconds, "agent_seconds": args.agent_seconds}, "levels": []}
+    try:
+        wait_ready(base, server)
+        for sessions in (int(n) for n in args.levels.split(",")):
+            print(f"… {sessions} concurrent sessions", file=sys.stderr)
+            result["levels"].append(run_level(base, server.pid, sessions, payload, args.timeout))
+    except RuntimeError as exc:
+        print(f"FAIL: {exc}; server log: {log.name}")
+        return 1
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"{result['label']}: breadth {args.breadth}, depth {args.depth}, {args.report_mode} report, "
+          f"mock agent {args.agent_seconds}s, mock LLM {args.llm_seconds}s\n")
+    print_levels(result["levels"])
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    return 1 if any(level["errors"] for level in result["levels"]) else 0
+
+def compare(args) -> int:
+    runs = []
+    for path in args.results:
+        with open(path) as f:
+            runs.append(json.load(f))
+    baseline = runs[0]
+    for run_ in runs:
+        if run_["payload"] != baseline["payload"] or run_["backend"] != baseline["backend"]:
+            print(f"note: {run_['label']} used different request or backend settings from {baseline['label']}")
+    sessions = sorted({level["sessions"] for run_ in runs for level in run_["levels"]})
+    width = max(len(run_["label"]) for run_ in runs)
+    for key, header, spec in METRICS[1:]:
+        print(f"\n{header} (ratio to {baseline['label']})")
+        print(f"{'':>{width}}  " + "  ".join(f"{n:>16}" for n in sessions))
+        base_levels = {level["sessions"]: level for level in baseline["levels"]}
+        for run_ in runs:
+            levels = {level["sessions"]: level for level in run_["levels"]}
+            cells = []
+            for n in sessions:
+                value = levels.get(n, {}).get(key)
+                ref = base_levels.get(n, {}).get(key)
+                ratio = f" ({value / ref:.2f}x)" if run_ is not baseline and value is not None and ref else ""
+                cells.append(f"{fmt(value, spec) + ratio:>16}")
+            print(f"{run_['label']:>{width}}  " + "  ".join(cells))
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    backend = argparse.ArgumentParser(add_help=False)
+    backend.add_argument("--engine", default=os.path.join(HERE, "deep_research_api.py"), help="engine module to load")
+    backend.add_argument("--llm-seconds", type=float, default=0.1, help="mean mock LLM latency")
+    backend.add_argument("--agent-seconds", type=float, default=1.0, help="mean mock agent run latency")
+
+    run_cmd = sub.add_parser("run", parents=[backend], help="ramp concurrent sessions and record metrics")
+    run_cmd.add_argument("--levels", default="1,10,50,100", help="comma-separated concurrent session counts")
+    run_cmd.add_argument("--breadth", type=int, default=3)
+    run_cmd.add_argument("--depth", type=int, default=2)
+    run_cmd.add_argument("--report-mode", choices=["single", "sectioned"], default="single")
+    run_cmd.add_argument("--timeout", type=float, default=600, help="seconds before a session counts as failed")
+    run_cmd.add_argument("--label", help="name for this run in comparisons (default: engine git revision)")
+    run_cmd.add_argument("--out", help="write results as JSON")
+
+    serve_cmd = sub.add_parser("serve", parents=[backend], help="run the API on the mock backend")
+    serve_cmd.add_argument("--port", type=int, default=8000)
+
+    compare_cmd = sub.add_parser("compare", help="compare result files; the first is the baseline")
+    compare_cmd.add_argument("results", nargs="+")
+
+    args = parser.parse_args()
+    return {"run": run, "serve": serve, "compare": compare}[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
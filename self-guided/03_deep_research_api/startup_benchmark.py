@@ -0,0 +1,81 @@
+"""
+Import-time benchmark for deep_research_api.
+
+Imports the API module in fresh interpreters with `python -X importtime`,
+then prints the median total import time and the slowest direct imports.
+It fails when an SDK that should load lazily shows up at import time, or
+when the median goes over --budget-ms.
+
+    python startup_benchmark.py                  # 5 runs, top 15 imports
+    python startup_benchmark.py --budget-ms 800  # use as a CI gate
+"""
+from __future__ import annotations
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+MODULE = "deep_research_api"
+
+# Must not be imported while deep_research_api loads; they are loaded on first use.
+LAZY_MODULES = ("openai", "numpy", "azure.ai.projects", "azure.ai.agents", "azure.identity")
+
+
+def importtime(module: str) -> list[tuple[str, int, int]]:
+    """Return (name, self_us, cumulative_us) rows from one `-X importtime` run."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    totals: list[float] = []
+    direct: dict[str, list[int]] = {}
+    eager: set[str] = set()
+    for _ in range(args.runs):
+        rows = importtime(MODULE)
+        for name, _self_us, cumulative_us in rows:
+            bare = name.strip()
+            if bare == MODULE:
+                totals.append(cumulative_us / 1000)
+            elif name.startswith("   ") and not name.startswith("    "):   # imported directly by MODULE
+                direct.setdefault(bare, []).append(cumulative_us)
+            eager.update(m for m in LAZY_MODULES if bare == m or bare.startswith(m + "."))
+
+    median_ms = statistics.median(totals)
+    print(f"{MODULE}: median import {median_ms:.0f} ms over {args.runs} runs (min {min(totals):.0f}, max {max(totals):.0f})\n")
+    print(f"{'cumulative ms':>14}  direct import")
+    slowest = sorted(direct.items(), key=lambda kv: statistics.median(kv[1]), reverse=True)[:args.top]
+    for name, samples in slowest:
+        print(f"{statistics.median(samples) / 1000:>14.1f}  {name}")
+
+    status = 0
+    if eager:
+        print(f"\nFAIL: imported eagerly but should load lazily: {', '.join(sorted(eager))}")
+        status = 1
+    if args.budget_ms is not None and median_ms > args.budget_ms:
+        print(f"\nFAIL: median import {median_ms:.0f} ms exceeds budget {args.budget_ms:.0f} ms")
+        status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())